@@ -3,34 +3,108 @@
 """
 Based on: https://github.com/datamade/dedupe-examples/tree/master/pgsql_big_dedupe_example
 """
+from __future__ import print_function
+
+import os
 import time
 import logging
 
 import psycopg2 as psy
-import psycopg2.extras
 
 import click
 
-from .utils import load_config, filename_friendly_hash, create_model_definition
+from . import instrument
+from .utils import load_config
+from .diagnostics import statement_cursor, analyze_loaded
 from .run import process_options,\
-    preprocess,\
-    train,\
-    create_blocking,\
-    cluster,\
     write_results,\
-    apply_results
+    apply_results,\
+    read_scores,\
+    cluster_scores,\
+    cluster_counts
+from .plan import plan as plan_clustering, print_plan
+from .files import run_files
+from .pipeline import STAGES, run_pipeline, load_model, settings_hash, table_exists
 
 START_TIME = time.time()
 
 
+def run_stages(config, db, plan=False, use_existing_tables=False, resume=False,
+               from_stage=None, to_stage=None, profile=None):
+    """Run the stages of a deduping run, or plan clustering after blocking"""
+    dbconfig = load_config(db)
+    config = process_options(load_config(config))
+    con = psy.connect(cursor_factory=statement_cursor(config), **dbconfig)
+    if config['table'] is None and not config['linkage']:
+        raise Exception('Key table must be defined in the config file; '
+                        'use pgdedupe-files to deduplicate input_file')
+    if resume and from_stage:
+        raise Exception('--resume and --from-stage cannot be used together')
+    if plan and config['partition_by']:
+        raise Exception('--plan cannot be used with partition_by')
+    if plan and config['linkage']:
+        raise Exception('--plan cannot be used with left_table and right_table')
+
+    if plan:
+        if use_existing_tables:
+            deduper = None
+        else:
+            deduper = run_pipeline(con, config, dbconfig, from_stage, 'create_blocking', resume)
+        logging.info("Planning...")
+        print_plan(plan_clustering(deduper or load_model(con, config), con, config))
+        con.close()
+        return
+
+    if profile and not os.path.isdir(profile):
+        os.makedirs(profile)
+    report = instrument.start_report(config, profile)
+    run_pipeline(con, config, dbconfig, from_stage, to_stage, resume)
+    instrument.tag(settings_hash=settings_hash(config))
+    instrument.finish_report(report, config['run_report'])
+
+    # Close our database connection
+    con.close()
+
+    print('ran in', time.time() - START_TIME, 'seconds')
+
+
+def stage_options(command):
+    """Add the options shared by the main and run commands"""
+    options = [
+        click.option('--config',
+                     help='YAML- or JSON-formatted configuration file.',
+                     required=True),
+        click.option('--db',
+                     help='YAML- or JSON-formatted database connection credentials.',
+                     required=True),
+        click.option('--plan', is_flag=True,
+                     help='Report block sizes, comparison counts and an estimated clustering '
+                          'time, then stop before clustering.'),
+        click.option('--use-existing-tables', is_flag=True,
+                     help='With --plan, read the blocking tables and saved model of a previous '
+                          'run instead of recreating them.'),
+        click.option('--resume', is_flag=True,
+                     help='Start at the first stage that did not complete in a previous run '
+                          'with the same configuration. An interrupted checkpointed clustering '
+                          'continues from its last committed block range.'),
+        click.option('--from-stage', type=click.Choice(STAGES),
+                     help='Start at this stage, reading the results of the earlier stages from '
+                          'the tables and saved model of a previous run.'),
+        click.option('--to-stage', type=click.Choice(STAGES),
+                     help='Stop after this stage.'),
+        click.option('--profile', type=click.Path(file_okay=False),
+                     help='Profile each stage with cProfile and write the stats to '
+                          '<stage>.prof in this directory.'),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
 @click.command()
-@click.option('--config',
-              help='YAML- or JSON-formatted configuration file.',
-              required=True)
-@click.option('--db',
-              help='YAML- or JSON-formatted database connection credentials.',
-              required=True)
-def main(config, db, verbosity=2):
+@stage_options
+def main(config, db, plan=False, use_existing_tables=False, resume=False,
+         from_stage=None, to_stage=None, profile=None, verbosity=2):
     log_level = logging.WARNING
     if verbosity == 1:
         log_level = logging.INFO
@@ -38,31 +112,48 @@ def main(config, db, verbosity=2):
         log_level = logging.DEBUG
     logging.getLogger().setLevel(log_level)
 
-    dbconfig = load_config(db)
-    con = psy.connect(cursor_factory=psycopg2.extras.RealDictCursor, **dbconfig)
+    run_stages(config, db, plan, use_existing_tables, resume, from_stage, to_stage, profile)
 
-    config = process_options(load_config(config))
 
-    logging.info("Preprocessing...")
-    preprocess(con, config)
-
-    logging.info("Training...")
-    deduper = train(con, config)
+@click.command()
+@stage_options
+def run(config, db, plan=False, use_existing_tables=False, resume=False,
+        from_stage=None, to_stage=None, profile=None, verbosity=2):
+    log_level = logging.WARNING
+    if verbosity == 1:
+        log_level = logging.INFO
+    elif verbosity is None or verbosity >= 2:
+        log_level = logging.DEBUG
+    logging.getLogger().setLevel(log_level)
 
-    logging.info("Creating blocking table...")
-    create_blocking(deduper, con, config)
+    run_stages(config, db, plan, use_existing_tables, resume, from_stage, to_stage, profile)
 
-    logging.info("Clustering...")
-    clustered_dupes = cluster(deduper, con, config)
 
-    logging.info("Writing results...")
-    write_results(clustered_dupes, con, config)
+@click.command()
+@click.option('--config',
+              help='YAML- or JSON-formatted configuration file.',
+              required=True)
+@click.option('--profile', type=click.Path(file_okay=False),
+              help='Profile each stage with cProfile and write the stats to '
+                   '<stage>.prof in this directory.')
+def files(config, profile=None, verbosity=2):
+    """Deduplicate the CSV or Parquet input_file into output_file, without a database"""
+    log_level = logging.WARNING
+    if verbosity == 1:
+        log_level = logging.INFO
+    elif verbosity is None or verbosity >= 2:
+        log_level = logging.DEBUG
+    logging.getLogger().setLevel(log_level)
 
-    logging.info("Applying results...")
-    apply_results(con, config)
+    config = process_options(load_config(config))
+    if config['input_file'] is None:
+        raise Exception('Key input_file must be defined in the config file')
 
-    # Close our database connection
-    con.close()
+    if profile and not os.path.isdir(profile):
+        os.makedirs(profile)
+    report = instrument.start_report(config, profile)
+    run_files(config)
+    instrument.finish_report(report, config['run_report'])
 
     print('ran in', time.time() - START_TIME, 'seconds')
 
@@ -74,7 +165,12 @@ def main(config, db, verbosity=2):
 @click.option('--db',
               help='YAML- or JSON-formatted database connection credentials.',
               required=True)
-def run(config, db, verbosity=2):
+@click.option('--threshold', type=float, multiple=True,
+              help='Clustering threshold. Defaults to the threshold in the configuration file. '
+                   'Give several to report the number of clusters at each without writing '
+                   'any results.')
+def recluster(config, db, threshold=(), verbosity=2):
+    """Re-cluster the pairs saved in scored_pairs by a run with persist_scores set"""
     log_level = logging.WARNING
     if verbosity == 1:
         log_level = logging.INFO
@@ -83,39 +179,39 @@ def run(config, db, verbosity=2):
     logging.getLogger().setLevel(log_level)
 
     dbconfig = load_config(db)
-    con = psy.connect(cursor_factory=psycopg2.extras.RealDictCursor, **dbconfig)
-
     config = process_options(load_config(config))
+    if config['partition_by']:
+        raise Exception('recluster does not support partition_by; the scored pairs are '
+                        'in the schemas of the partitions')
+    con = psy.connect(cursor_factory=statement_cursor(config), **dbconfig)
+    if not table_exists(con, '{schema}.scored_pairs'.format(**config)):
+        raise Exception('{schema}.scored_pairs does not exist; run pgdedupe with '
+                        'persist_scores or checkpoint_ranges set first'.format(**config))
+    thresholds = sorted(threshold) or [config['threshold']]
+
+    # All pairs are read: the ones below a threshold still count towards the average
+    # linkage of the clusters and the components they are split from
+    logging.info("Reading scored pairs...")
+    scores = read_scores(con, config)
+
+    if len(thresholds) > 1:
+        print('threshold', '# clusters', '# clustered records', sep='\t')
+        for row in cluster_counts(scores, config, thresholds):
+            print(*row, sep='\t')
+    else:
+        config['threshold'] = thresholds[0]
+
+        logging.info("Clustering...")
+        clustered_dupes = cluster_scores(scores, config)
+
+        logging.info("Writing results...")
+        write_results(clustered_dupes, con, config)
+        analyze_loaded(con)
+
+        logging.info("Applying results...")
+        apply_results(con, config, dbconfig)
+        analyze_loaded(con)
 
-    logging.info("Preprocessing...")
-    preprocess(con, config)
-
-    logging.info("Training...")
-    deduper = train(con, config)
-
-    # We need the memory-intensive objects for creating a model hash,
-    # so delete them afterwards instead of within train()
-    model_definition = create_model_definition(config, deduper)
-    logging.info('Model definition = %s', model_definition)
-    model_hash = filename_friendly_hash(model_definition)
-    logging.info('Model hash = %s', model_hash)
-
-    # free up some memory from the deduper
-    deduper.cleanupTraining()
-
-    logging.info("Creating blocking table...")
-    create_blocking(deduper, con, config)
-
-    logging.info("Clustering...")
-    clustered_dupes = cluster(deduper, con, config)
-
-    logging.info("Writing results...")
-    write_results(clustered_dupes, con, config)
-
-    logging.info("Applying results...")
-    apply_results(con, config)
-
-    # Close our database connection
     con.close()
 
     print('ran in', time.time() - START_TIME, 'seconds')
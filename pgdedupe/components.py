@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+Connected components of the graph of scored record pairs.
+
+Scored pairs are numpy structured arrays with a 'pairs' field holding the two record
+ids and a 'score' field, as produced by dedupe's scoring.
+"""
+import numpy
+
+
+def component_labels(pairs):
+    """Label every record in a list of pairs with its connected component (union-find)
+
+    Args:
+        pairs (iterable of (id, id) tuples) the edges of the graph
+
+    Returns: (dict) record id -> the smallest record id in its component
+    """
+    parent = {}
+
+    def find(x):
+        parent.setdefault(x, x)
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        # Path compression
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for a, b in pairs:
+        root_a, root_b = find(a), find(b)
+        # Keeping the smaller id as the root makes every root its component's minimum
+        if root_a < root_b:
+            parent[root_b] = root_a
+        elif root_b < root_a:
+            parent[root_a] = root_b
+
+    return dict((x, find(x)) for x in parent)
+
+
+def split_components(scores):
+    """Split scored pairs into the connected components they form
+
+    Args:
+        scores (numpy structured array) scored pairs
+
+    Returns: (list of numpy structured arrays) the pairs of each component, ordered by the
+        smallest record id in the component
+    """
+    if len(scores) == 0:
+        return []
+    labels = component_labels(scores['pairs'].tolist())
+    roots = numpy.array([labels[a] for a in scores['pairs'][:, 0].tolist()])
+    order = numpy.argsort(roots, kind='mergesort')
+    roots = roots[order]
+    boundaries = numpy.flatnonzero(numpy.diff(roots)) + 1
+    return numpy.split(scores[order], boundaries)
+
+
+def member_scores(component):
+    """The best score each record in a component has with any other record
+
+    Args:
+        component (numpy structured array) the scored pairs of one component
+
+    Returns: (dict) record id -> score
+    """
+    best = {}
+    for (a, b), score in zip(component['pairs'].tolist(), component['score'].tolist()):
+        for x in (a, b):
+            if score > best.get(x, -1):
+                best[x] = score
+    return best
+
+
+def component_cluster(component):
+    """Treat a whole component as a single cluster
+
+    Args:
+        component (numpy structured array) the scored pairs of one component
+
+    Returns: (tuple of ids, tuple of scores) in the format of dedupe's clustering, with ids
+        in increasing order and each record scored by its best pair
+    """
+    best = member_scores(component)
+    ids = sorted(best)
+    return tuple(ids), tuple(best[x] for x in ids)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+Record the SQL statements a run executes, with their duration and optionally their plan.
+
+With config['record_statements'] set, every statement executed on a pgdedupe connection
+is timed and added to the run_statements table in the dedupe schema. Every table created
+with CREATE TABLE AS is analyzed right away, so that the statements after it are planned
+with real statistics instead of those of an empty table. Tables loaded with COPY are often
+loaded in batches, so they are only noted, and analyze_loaded analyzes each of them once
+when the stage ends.
+
+With config['explain_statements'] set as well, statements that modify data are run with
+EXPLAIN (ANALYZE, BUFFERS) instead, which executes them just the same, and their plans
+are recorded too.
+"""
+import re
+import time
+import weakref
+import datetime
+import threading
+
+import psycopg2.extensions
+import psycopg2.extras
+
+from . import instrument
+
+RUN_STARTED_AT = datetime.datetime.now()
+
+CREATE_TABLE_AS = re.compile(r'\s*CREATE\s+TABLE\s+(IF\s+NOT\s+EXISTS\s+)?([\w.]+)\s+AS\b',
+                             re.IGNORECASE)
+COPY_FROM = re.compile(r'\s*COPY\s+([\w.]+)(\s*\([^)]*\))?\s+FROM\b', re.IGNORECASE)
+EXPLAINABLE = re.compile(r'\s*(INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+
+# The schemas in which this process has already created run_statements
+_created = set()
+# The tables loaded on each connection that have not been analyzed yet
+_loaded = weakref.WeakKeyDictionary()
+# Worker threads record statements on their own connections at the same time
+_lock = threading.Lock()
+
+
+class StatementRecordingCursor(psycopg2.extras.RealDictCursor):
+    """A RealDictCursor that records the statements it executes in run_statements
+
+    Use statement_cursor to get a subclass for a run's configuration. Server-side
+    (named) cursors are not recorded, since their work happens as their rows are fetched.
+    """
+    schema = None
+    explain = False
+
+    def __init__(self, *args, **kwargs):
+        super(StatementRecordingCursor, self).__init__(*args, **kwargs)
+        self._plan_rowcount = None
+
+    @property
+    def rowcount(self):
+        # An explained statement's own rowcount is that of its plan
+        if self._plan_rowcount is not None:
+            return self._plan_rowcount
+        return super(StatementRecordingCursor, self).rowcount
+
+    def execute(self, query, vars=None):
+        if self.name is not None:
+            return super(StatementRecordingCursor, self).execute(query, vars)
+        self._plan_rowcount = None
+        statement = self.mogrify(query, vars).decode('utf-8', 'replace')
+        create_table_as = CREATE_TABLE_AS.match(statement)
+        # CREATE TABLE IF NOT EXISTS ... AS can't be explained if the table exists
+        explain = self.explain and (EXPLAINABLE.match(statement) or
+                                    (create_table_as and not create_table_as.group(1)))
+        started_at = datetime.datetime.now()
+        start = time.time()
+        if explain:
+            super(StatementRecordingCursor, self).execute(
+                'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + statement)
+            plan = self.fetchone()['QUERY PLAN']
+            self._plan_rowcount = plan_rows(plan)
+        else:
+            super(StatementRecordingCursor, self).execute(query, vars)
+            plan = None
+        seconds = time.time() - start
+        self._record(statement, started_at, seconds, self.rowcount, plan)
+        if create_table_as:
+            self._analyze(create_table_as.group(2))
+
+    def copy_expert(self, sql, file, size=8192):
+        started_at = datetime.datetime.now()
+        start = time.time()
+        super(StatementRecordingCursor, self).copy_expert(sql, file, size)
+        self._record(sql, started_at, time.time() - start, self.rowcount, None)
+        copy_from = COPY_FROM.match(sql)
+        if copy_from:
+            self._note_loaded(copy_from.group(1))
+
+    def copy_from(self, file, table, *args, **kwargs):
+        started_at = datetime.datetime.now()
+        start = time.time()
+        super(StatementRecordingCursor, self).copy_from(file, table, *args, **kwargs)
+        self._record('COPY {} FROM STDIN'.format(table), started_at, time.time() - start,
+                     self.rowcount, None)
+        self._note_loaded(table)
+
+    def _analyze(self, table):
+        started_at = datetime.datetime.now()
+        start = time.time()
+        super(StatementRecordingCursor, self).execute('ANALYZE {}'.format(table))
+        self._record('ANALYZE {}'.format(table), started_at, time.time() - start, None, None)
+
+    def _note_loaded(self, table):
+        with _lock:
+            tables = _loaded.setdefault(self.connection, [])
+            if table not in tables:
+                tables.append(table)
+
+    def _record(self, statement, started_at, seconds, rows, plan):
+        c = self.connection.cursor(cursor_factory=psycopg2.extensions.cursor)
+        with _lock:
+            if self.schema not in _created:
+                c.execute("CREATE SCHEMA IF NOT EXISTS {}".format(self.schema))
+                c.execute("CREATE TABLE IF NOT EXISTS {}.run_statements "
+                          "(run_started_at TIMESTAMP, step TEXT, statement TEXT, "
+                          " started_at TIMESTAMP, seconds FLOAT, rows BIGINT, plan JSON)"
+                          .format(self.schema))
+                _created.add(self.schema)
+        c.execute("INSERT INTO {}.run_statements VALUES (%s, %s, %s, %s, %s, %s, %s)"
+                  .format(self.schema),
+                  (RUN_STARTED_AT, instrument.current_step(), statement, started_at, seconds,
+                   rows if rows is not None and rows >= 0 else None,
+                   psycopg2.extras.Json(plan) if plan is not None else None))
+        c.close()
+
+
+def analyze_loaded(con):
+    """Analyze the tables loaded with COPY on a connection since the last call, once each
+
+    Tables that have since been dropped or renamed are skipped. This does nothing unless
+    the connection records statements.
+
+    Args:
+        con (psycopg2.connection)
+    """
+    with _lock:
+        tables = _loaded.pop(con, [])
+    if not tables:
+        return
+    c = con.cursor()
+    for table in tables:
+        c.execute("SELECT to_regclass(%s) IS NOT NULL AS present", (table,))
+        if c.fetchone()['present']:
+            c.execute("ANALYZE {}".format(table))
+    con.commit()
+    c.close()
+
+
+def plan_rows(plan):
+    """The number of rows a statement produced or modified, from its EXPLAIN ANALYZE plan
+
+    Args:
+        plan (list) the plan of one statement, as returned by EXPLAIN (FORMAT JSON)
+    """
+    node = plan[0]['Plan']
+    if node['Node Type'] == 'ModifyTable' and node.get('Plans'):
+        # Without RETURNING, the modifying node itself returns no rows
+        node = node['Plans'][0]
+    return int(node['Actual Rows'] * node['Actual Loops'])
+
+
+def statement_cursor(config):
+    """The cursor class for pgdedupe connections, given a run's configuration
+
+    Returns: a StatementRecordingCursor subclass if config['record_statements'] or
+        config['explain_statements'] is set, otherwise psycopg2.extras.RealDictCursor
+    """
+    if not (config['record_statements'] or config['explain_statements']):
+        return psycopg2.extras.RealDictCursor
+    return type('StatementRecordingCursor', (StatementRecordingCursor,),
+                {'schema': config['schema'], 'explain': config['explain_statements']})
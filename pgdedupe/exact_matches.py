@@ -5,6 +5,9 @@ import tempfile
 import pandas as pd
 import numpy as np
 
+from . import instrument
+from .progress import Progress
+
 
 def follow(id1, edges, visited=None, weak=True):
     if visited is None:
@@ -24,19 +27,24 @@ def follow(id1, edges, visited=None, weak=True):
 
 
 # if sparse (a lot of disconnected vertices) find those separately (faster)
-def get_components(edges, vertices=None):
+def get_components(edges, vertices=None, progress=None):
     if vertices is None:
         vertices = pd.DataFrame({'id': pd.concat((edges['id1'], edges['id2'])).unique()})
 
     visited = set()
     components = {}
 
-    for id1 in vertices.values[:, 0]:
+    ids = vertices.values[:, 0]
+    if progress is not None:
+        ids = progress.track(ids)
+    for id1 in ids:
         if id1 not in visited:
             c = follow(id1, edges)
             visited.update(c)
             components[id1] = c
 
+    instrument.count('components', len(components))
+    instrument.count('component_records', len(visited))
     return components
 
 
@@ -52,7 +60,7 @@ def components_dict_to_df(components):
 
 def merge(mapping_table, mapping_id,
           entries_table, entry_id,
-          exact_columns, schema, con):
+          exact_columns, schema, con, config=None):
     """
     Given a mapping table that identifies clusters of entries in an entry table
     that are linked together, use a subset of columns to perform exact record-
@@ -66,11 +74,13 @@ def merge(mapping_table, mapping_id,
         exact_columns: a list of column names over which the exact merge should be performed
         schema: the schema where a temporary table may be created
         con: a connection to the database
+        config: configuration options for a deduping run, to report the progress of
+            finding the merged components with
     """
     edges = pd.read_sql("""
     with subset as (
-        SELECT {key}, {cluster}, {cols}
-        FROM {entries} LEFT JOIN {mapping} using ({key})
+        SELECT {key}, m.{cluster}, {cols}
+        FROM {entries} LEFT JOIN {mapping} m using ({key})
     )
 
     SELECT t1.{cluster} id1, id2 from
@@ -82,7 +92,12 @@ def merge(mapping_table, mapping_id,
     """.format(cols=', '.join(exact_columns), entries=entries_table,
                mapping=mapping_table, key=entry_id, cluster=mapping_id), con)
 
-    components = components_dict_to_df(get_components(edges))
+    vertices = pd.DataFrame({'id': pd.concat((edges['id1'], edges['id2'])).unique()})
+    progress = None
+    if config is not None:
+        progress = Progress('merging exact matches on ' + ', '.join(exact_columns),
+                            len(vertices), config, 'clusters')
+    components = components_dict_to_df(get_components(edges, vertices, progress))
 
     c = con.cursor()
     with tempfile.TemporaryFile(mode='w+t') as f:
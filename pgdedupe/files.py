@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run the deduplication stages over local CSV or Parquet files instead of Postgres.
+
+The records are read from config['input_file'], and every source row is written to
+config['output_file'] with its key, dedupe_id and cluster_score. The stages work in
+memory and on numpy arrays memory-mapped from config['work_dir'], so there are no
+database round trips or table rewrites.
+
+The blocks are kept like the blocking tables of a Postgres run: the _unique_ids of the
+plural blocks sorted by block_id (plural_block) and, for every record, the sorted ids of
+the blocks it is in (covered_blocks), from which the smaller block ids of the
+redundancy-free comparisons are taken.
+"""
+import os
+import array
+import shutil
+import logging
+import tempfile
+
+import numpy
+import pandas as pd
+
+from . import components
+from . import instrument
+from .records import record_type
+from .progress import Progress
+from .utils import filename_friendly_hash, create_model_definition
+from .run import train, score_blocks, sort_scores, cluster_scores, BlockingError
+
+
+def read_table(filename, columns):
+    """Read the given columns of a CSV or Parquet file
+
+    CSV values are all read as strings, as they would be from text columns. Parquet
+    files need pandas 0.21 or later and pyarrow or fastparquet (the parquet extra).
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.csv':
+        return pd.read_csv(filename, usecols=columns, dtype=str)
+    elif ext in ('.parquet', '.pq'):
+        return pd.read_parquet(filename, columns=columns)
+    else:
+        raise Exception('unknown filetype %s' % ext)
+
+
+def write_table(df, filename):
+    """Write a DataFrame to a CSV or Parquet file, by its extension"""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.csv':
+        df.to_csv(filename, index=False)
+    elif ext in ('.parquet', '.pq'):
+        df.to_parquet(filename, index=False)
+    else:
+        raise Exception('unknown filetype %s' % ext)
+
+
+def memmap(work_dir, name, values):
+    """Save an array to work_dir and map it back read-only, so it is only paged in as used"""
+    filename = os.path.join(work_dir, name + '.npy')
+    numpy.save(filename, values)
+    return numpy.load(filename, mmap_mode='r')
+
+
+def preprocess(config):
+    """Read the input file and merge exact duplicates
+
+    Args:
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+
+    Returns: (pandas.DataFrame) the source rows, with the key, the fields and the columns
+        of merge_exact; (numpy.ndarray) the _unique_id of each row; and (list of Record)
+        the unique records, indexed by _unique_id
+    """
+    fields = sorted(set(f['field'] for f in config['fields']))
+    columns = set(fields) | set(c for cols in config['merge_exact'] for c in cols)
+    rows = read_table(config['input_file'], sorted(columns | set([config['key']])))
+
+    # Number the distinct combinations of the fields in the order they first appear.
+    # factorize codes missing values as -1, so as with GROUP BY they are equal to each other
+    unique_ids = numpy.zeros(len(rows), dtype=numpy.int64)
+    for field in fields:
+        codes, uniques = pd.factorize(rows[field])
+        unique_ids = pd.factorize(unique_ids * (len(uniques) + 1) + codes + 1)[0]
+    first = numpy.unique(unique_ids, return_index=True)[1]
+    unique = rows[fields].iloc[first].astype(object)
+    unique = unique.where(unique.notnull(), None)
+
+    cls = record_type(fields + ['_unique_id'])
+    records = [cls(values + (i,))
+               for i, values in enumerate(unique.itertuples(index=False, name=None))]
+    logging.info('%s rows, %s unique records', len(rows), len(records))
+    return rows, unique_ids, records
+
+
+def create_blocking(deduper, records, config, work_dir):
+    """Block the records and keep the plural blocks as memory-mapped arrays
+
+    Args:
+        deduper (dedupe.Dedupe or dedupe.StaticDedupe) A trained Dedupe object
+        records (list of Record) the unique records, indexed by _unique_id
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        work_dir (str) the directory for the arrays
+
+    Returns: (dict) the arrays 'block_ids' and 'unique_ids' of plural_block, sorted by
+        block_id, and 'record_offsets' and 'record_blocks': the sorted block_ids of record
+        i are record_blocks[record_offsets[i]:record_offsets[i + 1]]
+    """
+    print('creating inverted index')
+    for field in deduper.blocker.index_fields:
+        deduper.blocker.index(set(record[field] for record in records), field)
+
+    # Block keys are numbered as they are first seen, so only one copy of each is kept
+    print('writing blocking map')
+    progress = Progress('blocking records', len(records), config, 'records')
+    key_ids = {}
+    keys, ids = array.array('q'), array.array('q')
+    full_data = ((record['_unique_id'], record) for record in progress.track(records))
+    for block_key, unique_id in instrument.counted(deduper.blocker(full_data), 'block_keys'):
+        keys.append(key_ids.setdefault(block_key, len(key_ids)))
+        ids.append(unique_id)
+    del key_ids
+    keys = numpy.frombuffer(keys, dtype=numpy.int64)
+    ids = numpy.frombuffer(ids, dtype=numpy.int64)
+
+    # Blocks with a single record have nothing to compare
+    plural = numpy.bincount(keys, minlength=1) > 1
+    plural_ids = numpy.cumsum(plural) - 1
+    in_plural = plural[keys]
+    block_ids, unique_ids = plural_ids[keys[in_plural]], ids[in_plural]
+    del keys, ids, in_plural
+    logging.info('%s plural blocks', int(plural.sum()))
+
+    order = numpy.lexsort((unique_ids, block_ids))
+    blocks = {'block_ids': memmap(work_dir, 'block_ids', block_ids[order]),
+              'unique_ids': memmap(work_dir, 'unique_ids', unique_ids[order])}
+    order = numpy.lexsort((block_ids, unique_ids))
+    blocks['record_blocks'] = memmap(work_dir, 'record_blocks', block_ids[order])
+    blocks['record_offsets'] = memmap(
+        work_dir, 'record_offsets',
+        numpy.searchsorted(unique_ids[order], numpy.arange(len(records) + 1)))
+    return blocks
+
+
+def candidates(blocks, records):
+    """Yield the plural blocks in the form of run.candidates_gen:
+        lists of (unique id, record, smaller block ids)
+
+    Args:
+        blocks (dict) the block arrays, as returned by create_blocking
+        records (list of Record) the unique records, indexed by _unique_id
+    """
+    block_ids, unique_ids = blocks['block_ids'], blocks['unique_ids']
+    offsets, record_blocks = blocks['record_offsets'], blocks['record_blocks']
+    if len(block_ids) == 0:
+        return
+    starts = numpy.flatnonzero(numpy.diff(block_ids)) + 1
+    starts = numpy.concatenate(([0], starts))
+    ends = numpy.concatenate((starts[1:], [len(block_ids)]))
+    empty = frozenset()
+    for start, end, block_id in zip(starts.tolist(), ends.tolist(),
+                                    block_ids[starts].tolist()):
+        block = []
+        for unique_id in unique_ids[start:end].tolist():
+            covered = record_blocks[offsets[unique_id]:offsets[unique_id + 1]]
+            smaller = covered[:numpy.searchsorted(covered, block_id)]
+            block.append((unique_id, records[unique_id],
+                          frozenset(smaller.tolist()) if len(smaller) else empty))
+        instrument.count('blocks')
+        instrument.count('block_records', len(block))
+        yield block
+
+
+def cluster(deduper, records, blocks, config, work_dir):
+    """Score the candidate pairs of all blocks and cluster them as described in
+    run.cluster_scores
+
+    If config['persist_scores'] is set, the scored pairs are also saved to
+    scored_pairs.npy in work_dir.
+
+    Returns: (generator of (cluster_id, scores) tuples)
+    """
+    block_ids = blocks['block_ids']
+    num_blocks = int(block_ids[-1]) + 1 if len(block_ids) else 0
+    progress = Progress('scoring blocks', num_blocks, config, 'blocks')
+    scores = score_blocks(deduper, progress.track(candidates(blocks, records)),
+                          deduper.num_cores)
+    if scores is None:
+        raise BlockingError('No records have been blocked together')
+    scores = sort_scores(scores)
+    if config['persist_scores']:
+        numpy.save(os.path.join(work_dir, 'scored_pairs.npy'), scores)
+    return cluster_scores(scores, config)
+
+
+def write_results(clustered_dupes, num_records):
+    """Map every unique record to its cluster, or to itself if it was not clustered
+
+    Returns: (numpy.ndarray) the canon_id and (numpy.ndarray) the cluster_score of every
+        record, by _unique_id
+    """
+    canon_ids = numpy.arange(num_records)
+    scores = numpy.ones(num_records)
+    num_clusters = 0
+    for cluster, member_scores in clustered_dupes:
+        num_clusters += 1
+        canon_ids[list(cluster)] = cluster[0]
+        scores[list(cluster)] = member_scores
+
+    print('# duplicate sets')
+    print(num_clusters)
+    return canon_ids, scores
+
+
+def merge_exact(rows, dedupe_ids, columns):
+    """Merge the clusters of rows that are equal in all of the given columns
+
+    Like exact_matches.merge, rows missing any of the columns are not merged.
+
+    Args:
+        rows (pandas.DataFrame) the source rows
+        dedupe_ids (numpy.ndarray) the cluster id of each row
+        columns (list of str) the columns to match on
+
+    Returns: (numpy.ndarray) the cluster id of each row after the merge; merged clusters
+        take the smallest of their ids
+    """
+    complete = rows[columns].notnull().all(axis=1).values
+    matched = rows.loc[complete, columns].assign(_dedupe_id=dedupe_ids[complete])
+    smallest = matched.groupby(columns, sort=False)['_dedupe_id'].transform('min')
+    edges = set(zip(dedupe_ids[complete].tolist(), smallest.tolist()))
+    labels = components.component_labels((a, b) for a, b in edges if a != b)
+    instrument.count('merged_clusters', sum(1 for x, root in labels.items() if x != root))
+    return numpy.fromiter((labels.get(x, x) for x in dedupe_ids.tolist()),
+                          dtype=numpy.int64, count=len(dedupe_ids))
+
+
+def apply_results(rows, unique_ids, canon_ids, scores, config):
+    """Run the exact-match merges and write every source row with its dedupe_id to
+    config['output_file']"""
+    dedupe_ids = canon_ids[unique_ids]
+    for cols in config['merge_exact']:
+        with instrument.measure('merge_exact ' + ', '.join(cols), None, config['schema']):
+            dedupe_ids = merge_exact(rows, dedupe_ids, cols)
+    write_table(pd.DataFrame({config['key']: rows[config['key']].values,
+                              'dedupe_id': dedupe_ids,
+                              'cluster_score': scores[unique_ids]}),
+                config['output_file'])
+    logging.info('wrote %s rows to %s', len(rows), config['output_file'])
+
+
+def run_files(config):
+    """Run all stages of a deduping run over config['input_file']
+
+    The memory-mapped arrays are written to config['work_dir'], or to a temporary
+    directory that is removed afterwards.
+
+    Args:
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+    """
+    if config['linkage'] or config['partition_by']:
+        raise Exception('input_file cannot be used with left_table and right_table '
+                        'or partition_by')
+    if config['filter_condition'] != '1=1':
+        raise Exception('filter_condition is SQL and cannot be applied to input_file')
+    work_dir = config['work_dir'] or tempfile.mkdtemp(prefix='pgdedupe_')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    def measure(stage):
+        logging.info("Running %s...", stage)
+        return instrument.measure(stage, None, config['schema'])
+
+    try:
+        with measure('preprocess'):
+            rows, unique_ids, records = preprocess(config)
+        with measure('train'):
+            # dedupe writes the labelled pairs to the training file as JSON, so it is
+            # given plain dicts of the fields
+            fields = set(f['field'] for f in config['fields'])
+            deduper = train(None, config,
+                            dict((i, dict((f, record[f]) for f in fields))
+                                 for i, record in enumerate(records)))
+            if not config['use_saved_model']:
+                model_hash = filename_friendly_hash(create_model_definition(config, deduper))
+                logging.info('Model hash = %s', model_hash)
+                instrument.tag(model_hash=model_hash)
+                deduper.cleanupTraining()
+        with measure('create_blocking'):
+            blocks = create_blocking(deduper, records, config, work_dir)
+        # The clusters are produced lazily while write_results consumes them
+        with measure('cluster+write_results'):
+            clustered_dupes = cluster(deduper, records, blocks, config, work_dir)
+            canon_ids, scores = write_results(clustered_dupes, len(records))
+        with measure('apply_results'):
+            apply_results(rows, unique_ids, canon_ids, scores, config)
+    finally:
+        if not config['work_dir']:
+            shutil.rmtree(work_dir, ignore_errors=True)
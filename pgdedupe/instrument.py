@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measure the time, memory and database work of each stage of a run.
+
+A RunReport collects one entry per measured step. Steps are measured with the measure
+context manager, which does nothing unless a report has been started, so the stage
+functions can be called on their own as before. Within a step, hot paths add to its
+counters with count and counted, and a report can also keep a cProfile dump per stage.
+Worker processes collect their counters with worker_counters and send them back to be
+added to the step with merge_counters.
+"""
+import os
+import json
+import time
+import socket
+import cProfile
+import logging
+import datetime
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_reports = []
+# The steps being measured, innermost last
+_active = []
+
+
+class RunReport(object):
+    """The measurements of one run, written out as JSON by finish_report"""
+
+    def __init__(self, config, profile_dir=None):
+        self.schema = config['schema']
+        self.profile_dir = profile_dir
+        self.started_at = datetime.datetime.now()
+        self.started = time.time()
+        self.tags = {}
+        self.stages = []
+
+    def as_dict(self):
+        report = {'schema': self.schema,
+                  'host': socket.gethostname(),
+                  'started_at': self.started_at.isoformat(),
+                  'wall_seconds': time.time() - self.started,
+                  'max_rss_kb': max_rss_kb(),
+                  'stages': self.stages}
+        report.update(self.tags)
+        return report
+
+
+def max_rss_kb():
+    """The peak resident memory of this process and of its finished worker processes"""
+    if resource is None:
+        return None
+    scale = 1024 if os.uname()[0] == 'Darwin' else 1  # macOS reports bytes
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak // scale
+
+
+def cpu_seconds():
+    """The user and system time used by this process and its finished worker processes"""
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def database_rows(con):
+    """Rows read and written so far in the current database, from pg_stat_database
+
+    The statistics are updated when transactions end, so these are approximate and
+    include the work of every connection to the database.
+    """
+    c = con.cursor()
+    c.execute("SELECT pg_stat_clear_snapshot()")
+    c.execute("SELECT tup_returned AS rows_read, "
+              "tup_inserted + tup_updated + tup_deleted AS rows_written "
+              "FROM pg_stat_database WHERE datname = current_database()")
+    row = c.fetchone()
+    c.close()
+    return int(row['rows_read']), int(row['rows_written'])
+
+
+def schema_tables(con, schema):
+    """The tables in a schema with their size on disk and row count
+
+    Row counts are the planner's estimates, None for tables that have not been analyzed.
+
+    Returns: (dict) table oid -> dict with the table's name, bytes and rows
+    """
+    c = con.cursor()
+    c.execute("SELECT c.oid, c.relname, pg_total_relation_size(c.oid) AS bytes, "
+              "c.reltuples::BIGINT AS rows "
+              "FROM pg_class c INNER JOIN pg_namespace n ON n.oid = c.relnamespace "
+              "WHERE n.nspname = %s AND c.relkind = 'r'", (schema,))
+    tables = {}
+    for row in c.fetchall():
+        tables[row['oid']] = {'table': row['relname'],
+                              'bytes': int(row['bytes']),
+                              'rows': int(row['rows']) if row['rows'] >= 0 else None}
+    c.close()
+    return tables
+
+
+def start_report(config, profile_dir=None):
+    """Start collecting measurements into a new RunReport
+
+    Args:
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        profile_dir (str) if given, profile each stage with cProfile and write the stats
+            to <stage>.prof in this directory
+    """
+    report = RunReport(config, profile_dir)
+    _reports.append(report)
+    return report
+
+
+def finish_report(report, filename=None):
+    """Stop collecting measurements and write the report to filename as JSON"""
+    _reports.remove(report)
+    if filename:
+        with open(filename, 'w') as f:
+            json.dump(report.as_dict(), f, indent=2, sort_keys=True)
+        logging.info('wrote run report to %s', filename)
+
+
+def count(name, n=1):
+    """Add n to a counter of the step being measured"""
+    if _active:
+        counters = _active[-1]['counters']
+        counters[name] = counters.get(name, 0) + n
+
+
+def counted(iterable, name):
+    """Count the items of an iterable as they are consumed
+
+    Adds the number of items to the counter name of the step being measured, and the
+    number of items per second, from the first item to the last, to name_per_second.
+    """
+    if not _active:
+        return iterable
+    return _counted(iterable, name, _active[-1]['counters'])
+
+
+def _counted(iterable, name, counters):
+    n = 0
+    start = time.time()
+    for item in iterable:
+        n += 1
+        yield item
+    seconds = time.time() - start
+    counters[name] = counters.get(name, 0) + n
+    counters[name + '_per_second'] = n / seconds if seconds > 0 else None
+
+
+@contextlib.contextmanager
+def worker_counters():
+    """Collect the counters of the work done in a worker process
+
+    A worker has no report of its own, so the counters are yielded to be returned to the
+    parent process, which adds them to the step being measured with merge_counters.
+
+    Yields: (dict) counter name -> value, filled in as the work is done
+    """
+    counters = {}
+    _active.append({'stage': current_step(), 'counters': counters})
+    try:
+        yield counters
+    finally:
+        _active.pop()
+
+
+def merge_counters(counters):
+    """Add the counters returned by a worker process to the step being measured
+
+    Rates (the _per_second counters) are left out; those of workers running at the same
+    time cannot be added up.
+    """
+    for name, n in counters.items():
+        if not name.endswith('_per_second'):
+            count(name, n)
+
+
+def current_step():
+    """The name of the innermost step being measured, or None"""
+    return _active[-1]['stage'] if _active else None
+
+
+def tag(**tags):
+    """Add values, like the model hash, to the report being collected"""
+    for report in _reports:
+        report.tags.update(tags)
+
+
+@contextlib.contextmanager
+def measure(name, con, schema):
+    """Measure a step of the run and add it to the report being collected
+
+    Records wall and CPU seconds, the peak memory so far, the rows read and written in
+    the database, and the tables created (or recreated) in the schema with their size.
+
+    Args:
+        name (str) the name of the step in the report
+        con (psycopg2.connection) or None for a step that does not use a database
+        schema (str) the schema whose new tables should be reported
+    """
+    if not _reports:
+        yield
+        return
+    if con is not None:
+        tables_before = schema_tables(con, schema)
+        rows_read, rows_written = database_rows(con)
+    stage = {'stage': name, 'counters': {}}
+    profile_dirs = [report.profile_dir for report in _reports if report.profile_dir]
+    # Only whole stages are profiled; cProfile cannot profile a step within one
+    profiler = cProfile.Profile() if profile_dirs and not _active else None
+    _active.append(stage)
+    cpu, wall = cpu_seconds(), time.time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            # Also keep the profile of an interrupted stage; that is often the slow one
+            for profile_dir in profile_dirs:
+                profiler.dump_stats(os.path.join(profile_dir, '{}.prof'.format(name)))
+        _active.pop()
+    stage.update({'wall_seconds': time.time() - wall,
+                  'cpu_seconds': cpu_seconds() - cpu,
+                  'max_rss_kb': max_rss_kb()})
+    if con is not None:
+        rows_read_after, rows_written_after = database_rows(con)
+        stage['rows_read'] = rows_read_after - rows_read
+        stage['rows_written'] = rows_written_after - rows_written
+        stage['tables'] = sorted((table for oid, table in schema_tables(con, schema).items()
+                                  if oid not in tables_before), key=lambda t: t['table'])
+    logging.info('%s took %.1f seconds', name, stage['wall_seconds'])
+    if stage['counters']:
+        logging.info('%s counters: %s', name, stage['counters'])
+    for report in _reports:
+        report.stages.append(stage)
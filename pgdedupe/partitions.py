@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run blocking and clustering separately for each value of config['partition_by'].
+
+Records in different partitions are never compared, so every partition can be blocked
+and clustered on its own, in parallel, with the model trained on all of the data. Each
+partition works in its own schema, <schema>_part<n>, on a copy of its rows of
+entries_unique that keeps their _unique_ids. The cluster ids of all partitions are
+therefore distinct, and their entity maps can simply be combined.
+"""
+import re
+import logging
+import multiprocessing
+
+import psycopg2
+
+from . import instrument
+from .diagnostics import statement_cursor, analyze_loaded
+from .session import apply_settings
+from .run import create_schema, train, create_blocking, cluster, write_results, BlockingError
+
+
+def partition_values(con, config):
+    """The distinct values of the partition column in entries_unique, in order"""
+    c = con.cursor()
+    c.execute("SELECT DISTINCT {partition_by} AS value FROM {schema}.entries_unique "
+              "ORDER BY 1".format(**config))
+    values = [row['value'] for row in c.fetchall()]
+    c.close()
+    return values
+
+
+def partition_config(config, i):
+    """The configuration for working on partition i in its own schema
+
+    Partitions already run in parallel, so they score and cluster in a single process.
+    """
+    return dict(config, schema='{}_part{}'.format(config['schema'], i), num_cores=1,
+                cluster_workers=1, clustering_workers=1)
+
+
+def create_partition(con, config, part_config, value):
+    """Copy the rows of one partition of entries_unique into the partition's schema"""
+    c = con.cursor()
+    create_schema(c, part_config)
+    c.execute("DROP TABLE IF EXISTS {schema}.entries_unique".format(**part_config))
+    c.execute("CREATE TABLE {}.entries_unique AS SELECT * FROM {schema}.entries_unique "
+              "WHERE {partition_by} IS NOT DISTINCT FROM %s".format(part_config['schema'],
+                                                                    **config), (value,))
+    c.execute("ALTER TABLE {schema}.entries_unique ADD PRIMARY KEY (_unique_id)"
+              .format(**part_config))
+    con.commit()
+    c.close()
+
+
+def drop_stale_partitions(con, config, n):
+    """Drop the schemas of partitions numbered n or above, left behind by a previous run
+    that had more partition values
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        n (int) the number of partitions of this run
+    """
+    part_schema = re.compile(re.escape(config['schema']) + r'_part(\d+)$')
+    c = con.cursor()
+    c.execute("SELECT nspname FROM pg_namespace ORDER BY 1")
+    matches = [part_schema.match(row['nspname']) for row in c.fetchall()]
+    stale = [m.group(0) for m in matches if m and int(m.group(1)) >= n]
+    for schema in stale:
+        logging.info('dropping stale partition schema %s', schema)
+        c.execute('DROP SCHEMA "{}" CASCADE'.format(schema))
+    con.commit()
+    c.close()
+
+
+def partition_stage(args):
+    """Run a stage on one partition, with its own connection and the saved model
+
+    For 'create_blocking', the partition's rows are copied from entries_unique and
+    blocked. For 'cluster', they are clustered and the clusters written to the
+    partition's entity_map.
+
+    Args:
+        args (tuple) database credentials, configuration options, the stage, the partition
+            number and the partition value. Packed in one tuple for use with
+            multiprocessing.Pool.imap_unordered
+
+    Returns: (int) the partition number and (dict) the counters of its work, for
+        instrument.merge_counters
+    """
+    dbconfig, config, stage, i, value = args
+    part_config = partition_config(config, i)
+    con = psycopg2.connect(cursor_factory=statement_cursor(config), **dbconfig)
+    apply_settings(con, config, stage)
+    deduper = train(con, dict(part_config, use_saved_model=True))
+    with instrument.worker_counters() as counters:
+        if stage == 'create_blocking':
+            create_partition(con, config, part_config, value)
+            create_blocking(deduper, con, part_config)
+        else:
+            try:
+                clustered_dupes = cluster(deduper, con, part_config)
+            except BlockingError:
+                # Not a single pair of records in this partition was blocked together
+                clustered_dupes = []
+            write_results(clustered_dupes, con, part_config)
+    analyze_loaded(con)
+    con.close()
+    logging.info('%s done for %s = %s', stage, config['partition_by'], value)
+    return i, counters
+
+
+def run_partitions(con, config, stage, dbconfig=None):
+    """Run a stage on every partition, in config['partition_workers'] processes
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        stage (str) 'create_blocking' or 'cluster'
+        dbconfig (dict) database connection credentials for the partitions' connections
+    """
+    if dbconfig is None:
+        raise Exception('partition_by requires the database credentials')
+    values = partition_values(con, config)
+    logging.info('%s: %s partitions by %s', stage, len(values), config['partition_by'])
+    if stage == 'create_blocking':
+        drop_stale_partitions(con, config, len(values))
+    work = [(dbconfig, config, stage, i, value) for i, value in enumerate(values)]
+    if config['partition_workers'] > 1:
+        pool = multiprocessing.Pool(config['partition_workers'])
+        try:
+            for _, counters in pool.imap_unordered(partition_stage, work):
+                instrument.merge_counters(counters)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for args in work:
+            instrument.merge_counters(partition_stage(args)[1])
+
+
+def combine_entity_maps(con, config):
+    """Combine the entity maps of all partitions into the entity_map table
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+    """
+    parts = [partition_config(config, i)['schema']
+             for i in range(len(partition_values(con, config)))]
+    c = con.cursor()
+    c.execute("DROP TABLE IF EXISTS {schema}.entity_map".format(**config))
+    c.execute("CREATE TABLE {schema}.entity_map "
+              "(_unique_id INT, canon_id INT, "
+              " cluster_score FLOAT, PRIMARY KEY(_unique_id))".format(**config))
+    for part in parts:
+        c.execute("INSERT INTO {schema}.entity_map SELECT _unique_id, canon_id, cluster_score "
+                  "FROM {part}.entity_map".format(part=part, **config))
+    c.execute("CREATE INDEX head_index ON {schema}.entity_map (canon_id)".format(**config))
+    c.execute("SELECT count(DISTINCT canon_id) AS n FROM {schema}.entity_map".format(**config))
+    num_clusters = c.fetchone()['n']
+    con.commit()
+    c.close()
+
+    print('# duplicate sets')
+    print(num_clusters)
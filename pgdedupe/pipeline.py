@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run the deduplication stages in order, skipping the ones that are already done.
+
+Every completed stage is recorded in the pipeline_state table, together with a hash
+of the inputs it depended on. A later run can then start at the first stage whose
+inputs changed, whose artifacts are missing or that never completed.
+"""
+import os
+import hashlib
+import logging
+
+from . import instrument
+from .session import tuned
+from .diagnostics import analyze_loaded
+from .partitions import run_partitions, combine_entity_maps
+from .utils import filename_friendly_hash, create_model_definition
+from .run import preprocess,\
+    train,\
+    create_blocking,\
+    cluster,\
+    write_results,\
+    apply_results,\
+    read_scores,\
+    cluster_scores
+
+STAGES = ('preprocess', 'train', 'create_blocking', 'cluster', 'write_results', 'apply_results')
+
+# The tables in the dedupe schema each stage leaves behind
+STAGE_TABLES = {
+    'preprocess': ('entries_unique',),
+    'train': (),
+    'create_blocking': ('plural_key', 'plural_block', 'smaller_coverage'),
+    'cluster': ('scored_pairs',),
+    'write_results': ('entity_map',),
+    'apply_results': ('unique_map',),
+}
+
+# The configuration options each stage's results depend on, besides the model
+STAGE_OPTIONS = {
+    'preprocess': ('table', 'left_table', 'right_table', 'key', 'fields', 'filter_condition',
+                   'partition_by'),
+    'train': ('interactions', 'classifier', 'hyperparameters', 'recall', 'seed'),
+    'create_blocking': (),
+    'cluster': (),
+    'write_results': ('threshold', 'clustering', 'max_hierarchical_size'),
+    'apply_results': ('merge_exact', 'apply_mode', 'stable_ids'),
+}
+
+
+def settings_hash(config):
+    """Hash the saved model in config['settings_file'], or None if there is none"""
+    if not os.path.exists(config['settings_file']):
+        return None
+    with open(config['settings_file'], 'rb') as sf:
+        return hashlib.md5(sf.read()).hexdigest()
+
+
+def stage_options(stage, config):
+    """The configuration options a stage's results depend on
+
+    With partition_by, the cluster stage also writes the entity map of every partition,
+    so it depends on the options of write_results as well.
+    """
+    options = STAGE_OPTIONS[stage]
+    if stage == 'cluster' and config['partition_by']:
+        options += STAGE_OPTIONS['write_results']
+    return options
+
+
+def stage_hash(stage, config):
+    """Hash everything a stage's results depend on: its options, the options of the stages
+    before it and, after training, the saved model"""
+    inputs = {}
+    for previous in STAGES[:STAGES.index(stage) + 1]:
+        inputs.update((k, config[k]) for k in stage_options(previous, config))
+    if STAGES.index(stage) > STAGES.index('train'):
+        inputs['model'] = settings_hash(config)
+    return filename_friendly_hash(inputs)
+
+
+def table_exists(con, table):
+    c = con.cursor()
+    c.execute("SELECT to_regclass(%s) IS NOT NULL AS present", (table,))
+    present = c.fetchone()['present']
+    c.close()
+    return present
+
+
+def completed_stages(con, config):
+    """Find the stages recorded as completed whose inputs and artifacts are still in place
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+
+    Returns: (list of str) the completed stages, in order. Only the stages before the
+        first incomplete one are returned. A cluster stage whose scores were not saved
+        counts as completed if write_results did.
+    """
+    if not table_exists(con, '{schema}.pipeline_state'.format(**config)):
+        return []
+    c = con.cursor()
+    c.execute("SELECT stage, input_hash FROM {schema}.pipeline_state".format(**config))
+    recorded = dict((row['stage'], row['input_hash']) for row in c.fetchall())
+    c.close()
+
+    completed = []
+    for stage in STAGES:
+        if stage == 'cluster' and recorded.get('cluster') is None:
+            # Without saved scores, cluster is not recorded itself, but it completed
+            # if the entity map written from its clusters is still current
+            if (recorded.get('write_results') == stage_hash('write_results', config) and
+                    table_exists(con, '{schema}.entity_map'.format(**config))):
+                completed.append(stage)
+                continue
+        if recorded.get(stage) != stage_hash(stage, config):
+            break
+        if stage == 'train' and settings_hash(config) is None:
+            break
+        tables = STAGE_TABLES[stage]
+        if config['partition_by'] and stage in ('create_blocking', 'cluster'):
+            # These are in the schemas of the partitions
+            tables = ()
+        if not all(table_exists(con, '{}.{}'.format(config['schema'], table))
+                   for table in tables):
+            break
+        completed.append(stage)
+    return completed
+
+
+def start_stage(con, config, stage):
+    """Forget that a stage and every stage after it have completed"""
+    c = con.cursor()
+    c.execute("CREATE SCHEMA IF NOT EXISTS {schema}".format(**config))
+    c.execute("CREATE TABLE IF NOT EXISTS {schema}.pipeline_state "
+              "(stage TEXT PRIMARY KEY, input_hash TEXT, completed_at TIMESTAMP)"
+              .format(**config))
+    c.execute("DELETE FROM {schema}.pipeline_state WHERE stage = ANY(%s)".format(**config),
+              (list(STAGES[STAGES.index(stage):]),))
+    con.commit()
+    c.close()
+
+
+def complete_stage(con, config, stage):
+    """Record that a stage has completed"""
+    c = con.cursor()
+    c.execute("INSERT INTO {schema}.pipeline_state (stage, input_hash, completed_at) "
+              "VALUES (%s, %s, now())".format(**config), (stage, stage_hash(stage, config)))
+    con.commit()
+    c.close()
+
+
+def load_model(con, config):
+    """Read the saved model from config['settings_file'] instead of training"""
+    return train(con, dict(config, use_saved_model=True))
+
+
+def run_pipeline(con, config, dbconfig=None, from_stage=None, to_stage=None, resume=False):
+    """Run the deduplication stages from from_stage through to_stage
+
+    Stages before the first one to run are not repeated; their results are read from the
+    database and the saved model instead. With resume, the run starts at the first stage
+    that did not complete in a previous run with the same inputs (see completed_stages).
+    If that is a checkpointed cluster stage, clustering continues from its last committed
+    block range.
+
+    The cluster stage only counts as completed if its scored pairs are saved
+    (persist_scores or checkpoint_ranges). Otherwise it always runs together with
+    write_results, which consumes its clusters as they are produced, and the two are
+    measured as the single stage 'cluster+write_results'.
+
+    With config['partition_by'], create_blocking and cluster run for each partition
+    (see partitions.run_partitions) and write_results combines the partitions' entity maps.
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        dbconfig (dict) database connection credentials, for stages with worker connections
+        from_stage (str) the first stage to run; defaults to the first stage
+        to_stage (str) the last stage to run; defaults to the last stage
+        resume (bool) start at the first stage that has not completed instead of from_stage
+
+    Returns: (dedupe.Dedupe or dedupe.StaticDedupe) the model, if any stage needed it
+    """
+    completed = completed_stages(con, config) if resume else []
+    if resume:
+        from_stage = STAGES[len(completed)] if len(completed) < len(STAGES) else None
+        if from_stage is None:
+            logging.info("All stages have already completed")
+            return None
+        logging.info("Resuming at %s", from_stage)
+    first = STAGES.index(from_stage or STAGES[0])
+    last = STAGES.index(to_stage or STAGES[-1])
+    to_run = STAGES[first:last + 1]
+    # Clustering results are only kept as persisted scores, or as the entity maps
+    # of the partitions
+    scores_saved = (config['persist_scores'] or config['checkpoint_ranges'] or
+                    config['partition_by'])
+    if 'write_results' in to_run and 'cluster' not in to_run and not scores_saved:
+        raise Exception('write_results can only run without cluster if persist_scores, '
+                        'checkpoint_ranges or partition_by is set')
+
+    combined = not scores_saved and 'cluster' in to_run and 'write_results' in to_run
+
+    deduper = None
+    clustered_dupes = None
+    for stage in to_run:
+        if combined and stage == 'write_results':
+            # Already run with cluster
+            continue
+        start_stage(con, config, stage)
+        name = 'cluster+write_results' if combined and stage == 'cluster' else stage
+        logging.info("Running %s...", name)
+        with instrument.measure(name, con, config['schema']), tuned(con, config, stage):
+            if stage == 'preprocess':
+                preprocess(con, config)
+            elif stage == 'train':
+                deduper = train(con, config)
+                if not config['use_saved_model']:
+                    # We need the memory-intensive objects for creating a model hash,
+                    # so delete them afterwards instead of within train()
+                    model_definition = create_model_definition(config, deduper)
+                    model_hash = filename_friendly_hash(model_definition)
+                    logging.info('Model hash = %s', model_hash)
+                    instrument.tag(model_hash=model_hash)
+                    # free up some memory from the deduper
+                    deduper.cleanupTraining()
+            elif stage == 'create_blocking' and config['partition_by']:
+                run_partitions(con, config, 'create_blocking', dbconfig)
+            elif stage == 'cluster' and config['partition_by']:
+                run_partitions(con, config, 'cluster', dbconfig)
+            elif stage == 'write_results' and config['partition_by']:
+                combine_entity_maps(con, config)
+            elif stage == 'create_blocking':
+                deduper = deduper or load_model(con, config)
+                create_blocking(deduper, con, config)
+            elif stage == 'cluster':
+                deduper = deduper or load_model(con, config)
+                checkpoints = '{schema}.cluster_checkpoints'.format(**config)
+                resume_cluster = (resume and config['checkpoint_ranges'] and
+                                  'create_blocking' not in to_run and
+                                  table_exists(con, checkpoints))
+                clustered_dupes = cluster(deduper, con, config, dbconfig, bool(resume_cluster))
+                if combined:
+                    # The clusters are produced lazily while write_results consumes them
+                    with tuned(con, config, 'write_results'):
+                        write_results(clustered_dupes, con, config)
+            elif stage == 'write_results':
+                if clustered_dupes is None:
+                    clustered_dupes = cluster_scores(read_scores(con, config), config)
+                write_results(clustered_dupes, con, config)
+            elif stage == 'apply_results':
+                apply_results(con, config, dbconfig)
+            analyze_loaded(con)
+        if stage == 'cluster' and not scores_saved:
+            if combined:
+                complete_stage(con, config, 'write_results')
+            continue
+        complete_stage(con, config, stage)
+    return deduper
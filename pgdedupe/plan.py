@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+"""
+Estimate the amount of work a clustering run will take before starting it.
+
+All of these functions read the tables written by run.create_blocking, so they
+can be used right after blocking or against the tables left by a previous run.
+"""
+import time
+import logging
+
+from .run import candidates_gen, score_blocks, cluster_scores
+
+
+def block_size_histogram(con, config):
+    """Count the plural blocks by size, bucketed by powers of two
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+
+    Returns: (list of (int, int, int) tuples) lower bound, upper bound and number of blocks
+        for each non-empty bucket, in increasing order of size
+    """
+    c = con.cursor()
+    c.execute("SELECT block_size, count(*) AS num_blocks FROM ("
+              " SELECT count(*) AS block_size FROM {schema}.plural_block "
+              " GROUP BY block_id) s "
+              "GROUP BY block_size".format(**config))
+    buckets = {}
+    for row in c.fetchall():
+        lower = 1
+        while lower * 2 <= row['block_size']:
+            lower *= 2
+        buckets[lower] = buckets.get(lower, 0) + row['num_blocks']
+    c.close()
+    return [(lower, lower * 2 - 1, buckets[lower]) for lower in sorted(buckets)]
+
+
+def largest_blocks(con, config, n=10):
+    """Find the biggest blocks and the key that formed them
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        n (int) number of blocks to return
+
+    Returns: (list of dicts) with block_id, block_key and block_size
+    """
+    c = con.cursor()
+    c.execute("SELECT block_id, block_key, count(*) AS block_size "
+              "FROM {schema}.plural_block INNER JOIN {schema}.plural_key USING (block_id) "
+              "GROUP BY block_id, block_key "
+              "ORDER BY block_size DESC, block_id LIMIT %s".format(**config), (n,))
+    blocks = [dict(row) for row in c.fetchall()]
+    c.close()
+    return blocks
+
+
+def count_comparisons(con, config, sample):
+    """Estimate the record pairs that clustering will score
+
+    Blocks overlap, so a pair of records is only compared within the first block
+    they share (the redundancy-free filtering done with smaller_ids in candidates_gen).
+    Counting those pairs exactly would mean joining every block with itself, which is
+    as quadratic as scoring them. Instead, the n * (n - 1) / 2 pairs within each block
+    are counted from the block sizes in a single scan of plural_block, and reduced by the
+    share of pairs that the sampled blocks skip as redundant.
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        sample (dict) the sampled blocks' number of pairs and comparisons, as returned by
+            measure_throughput
+
+    Returns: (dict) with the number of pairs within blocks ('naive') and the estimated
+        number of pairs left after redundancy-free filtering ('comparisons')
+    """
+    c = con.cursor()
+    c.execute("SELECT COALESCE(sum(block_size * (block_size - 1) / 2), 0) AS naive FROM ("
+              " SELECT count(*)::BIGINT AS block_size FROM {schema}.plural_block "
+              " GROUP BY block_id) s".format(**config))
+    naive = int(c.fetchone()['naive'])
+    c.close()
+    comparisons = naive
+    if sample['pairs']:
+        comparisons = int(round(naive * float(sample['comparisons']) / sample['pairs']))
+    return {'naive': naive, 'comparisons': comparisons}
+
+
+def block_comparisons(block):
+    """Count the pairs within a block from candidates_gen that will actually be scored"""
+    n = 0
+    for i, (_, _, smaller_ids_1) in enumerate(block):
+        for (_, _, smaller_ids_2) in block[i + 1:]:
+            if smaller_ids_1.isdisjoint(smaller_ids_2):
+                n += 1
+    return n
+
+
+def measure_throughput(deduper, con, config):
+    """Time clustering on a sample of blocks
+
+    Blocks are sampled in a fixed pseudo-random order so repeated plans are comparable.
+
+    Args:
+        deduper (dedupe.Dedupe or dedupe.StaticDedupe) A trained Dedupe object
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+
+    Returns: (dict) with the number of sampled blocks, the pairs within them and the
+        comparisons left of those, the seconds it took to score and cluster them and the
+        resulting comparisons per second
+    """
+    c = con.cursor('plan_sample')
+    c.execute("SELECT {all_columns}, block_id, smaller_ids FROM {schema}.smaller_coverage "
+              "INNER JOIN {schema}.entries_unique USING (_unique_id) "
+              "WHERE block_id IN (SELECT block_id FROM {schema}.plural_key "
+              "                   ORDER BY md5(block_id::TEXT) LIMIT %s) "
+              "ORDER BY (block_id)".format(**config), (config['plan_sample_blocks'],))
+    blocks = list(candidates_gen(c))
+    c.close()
+
+    pairs = sum(len(block) * (len(block) - 1) // 2 for block in blocks)
+    comparisons = sum(block_comparisons(block) for block in blocks)
+    start = time.time()
+    scores = score_blocks(deduper, iter(blocks), deduper.num_cores)
+    if scores is not None:
+        list(cluster_scores(scores, config))
+    seconds = time.time() - start
+    return {'blocks': len(blocks),
+            'pairs': pairs,
+            'comparisons': comparisons,
+            'seconds': seconds,
+            'comparisons_per_second': comparisons / seconds if seconds > 0 else None}
+
+
+def plan(deduper, con, config):
+    """Report on the work that clustering the current blocking tables would take
+
+    Args:
+        deduper (dedupe.Dedupe or dedupe.StaticDedupe) A trained Dedupe object
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+
+    Returns: (dict) the planning report
+    """
+    logging.info("measuring block sizes")
+    report = {'histogram': block_size_histogram(con, config),
+              'largest_blocks': largest_blocks(con, config)}
+    logging.info("scoring a sample of %s blocks", config['plan_sample_blocks'])
+    report['sample'] = measure_throughput(deduper, con, config)
+    logging.info("counting comparisons")
+    report.update(count_comparisons(con, config, report['sample']))
+    rate = report['sample']['comparisons_per_second']
+    report['estimated_seconds'] = report['comparisons'] / rate if rate else None
+    return report
+
+
+def print_plan(report):
+    """Print a planning report from plan() in a human-readable form"""
+    print('block size histogram')
+    for lower, upper, count in report['histogram']:
+        print('  {:>10} - {:<10} {:>12}'.format(lower, upper, count))
+    print('largest blocks')
+    for block in report['largest_blocks']:
+        print('  {block_id:>10} {block_size:>10}  {block_key}'.format(**block))
+    print('# pairs within blocks', report['naive'])
+    print('# comparisons after redundancy-free filtering (estimated)', report['comparisons'])
+    sample = report['sample']
+    print('sampled', sample['comparisons'], 'comparisons in', sample['blocks'], 'blocks,',
+          'scored in', sample['seconds'], 'seconds')
+    if report['estimated_seconds'] is None:
+        print('not enough sampled comparisons to estimate the clustering time')
+    else:
+        print('estimated clustering time', report['estimated_seconds'], 'seconds')
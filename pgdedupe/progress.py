@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""
+Report the progress of long-running steps while they run.
+
+Progress is logged at most every config['progress_interval'] seconds with the current
+throughput and, when the total amount of work is known, an estimated time to completion.
+If config['progress_file'] is set, the latest report is also written there as JSON, for
+schedulers and dashboards to poll.
+"""
+import os
+import json
+import time
+import logging
+import datetime
+
+
+class Progress(object):
+    """Track the progress of one step of a run
+
+    Args:
+        name (str) what is being done, e.g. 'scoring blocks'
+        total (int) the amount of work in the step, or None if it is not known
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        unit (str) what the work is counted in, e.g. 'blocks'
+    """
+
+    def __init__(self, name, total, config, unit='rows'):
+        self.name = name
+        self.total = total
+        self.unit = unit
+        self.interval = config['progress_interval']
+        self.filename = config['progress_file']
+        self.done = 0
+        self.started = self.reported = time.time()
+
+    def update(self, n=1):
+        """Add n units of work done, and report if the interval has passed"""
+        self.done += n
+        now = time.time()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            self.report()
+
+    def track(self, iterable, size=None):
+        """Yield the items of an iterable, counting each as done once it has been consumed
+
+        The progress is reported once more when the iterable is exhausted.
+
+        Args:
+            iterable (iterable)
+            size (function) the amount of work in an item; each item counts as one if None
+        """
+        for item in iterable:
+            yield item
+            self.update(1 if size is None else size(item))
+        self.report()
+
+    def status(self):
+        """The progress so far, as a dict"""
+        elapsed = time.time() - self.started
+        rate = self.done / elapsed if elapsed > 0 else None
+        eta = None
+        if self.total is not None and rate:
+            eta = max(self.total - self.done, 0) / rate
+        return {'step': self.name,
+                'unit': self.unit,
+                'done': self.done,
+                'total': self.total,
+                'elapsed_seconds': elapsed,
+                'per_second': rate,
+                'eta_seconds': eta,
+                'updated_at': datetime.datetime.now().isoformat()}
+
+    def report(self):
+        """Log the progress so far and write it to the progress file, if there is one"""
+        status = self.status()
+        message = '{step}: {done} {unit}'.format(**status)
+        if self.total is not None:
+            message += ' of {}'.format(self.total)
+        if status['per_second'] is not None:
+            message += ', {:.1f} {} per second'.format(status['per_second'], self.unit)
+        if status['eta_seconds'] is not None:
+            message += ', {} left'.format(datetime.timedelta(seconds=int(status['eta_seconds'])))
+        logging.info(message)
+        if self.filename:
+            # Write a new file and rename it over the old one, so that readers never
+            # see a partially written report
+            temporary = self.filename + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(status, f, sort_keys=True)
+            os.rename(temporary, self.filename)
+
+
+def count_rows(con, table):
+    """The number of rows in a table, to use as the total of a Progress"""
+    c = con.cursor()
+    c.execute("SELECT count(*) AS n FROM {}".format(table))
+    n = c.fetchone()['n']
+    c.close()
+    return n
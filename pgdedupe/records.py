@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact, read-only records for rows fetched as tuples.
+
+Dedupe only looks records up by field name, so a tuple with a per-column-list index
+is enough and costs a fraction of the memory of a dict per row.
+"""
+
+_record_types = {}
+
+
+class Record(tuple):
+    """A row of values that can be looked up by column name, like a read-only dict
+
+    Iterating over a record yields its values, as with a tuple. Use record_type to get a
+    subclass for a given list of column names.
+    """
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            return tuple.__getitem__(self, key)
+        return tuple.__getitem__(self, self._index[key])
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __reduce__(self):
+        return (make_record, (self._fields, tuple(self)))
+
+    def __repr__(self):
+        return 'Record({})'.format(', '.join('{}={!r}'.format(*item) for item in self.items()))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self._fields)
+
+    def items(self):
+        return list(zip(self._fields, self))
+
+
+def record_type(fields):
+    """Get the Record subclass for a sequence of column names
+
+    Classes are cached, so all rows with the same columns share one index.
+    """
+    fields = tuple(fields)
+    try:
+        return _record_types[fields]
+    except KeyError:
+        cls = type('Record', (Record,), {'__slots__': (),
+                                         '_fields': fields,
+                                         '_index': dict((f, i) for i, f in enumerate(fields))})
+        _record_types[fields] = cls
+        return cls
+
+
+def make_record(fields, values):
+    """Build a Record from column names and values; used to unpickle records"""
+    return record_type(fields)(values)
+
+
+def compact_rows(cursor):
+    """Wrap the tuples fetched by a psycopg2 cursor in Records named by its columns
+
+    Args:
+        cursor (psycopg2.cursor) an executed cursor returning tuples
+
+    Yields: (Record) one per row
+    """
+    rows = iter(cursor)
+    for first in rows:
+        # Named cursors only know their columns once the first rows have been fetched
+        cls = record_type(column[0] for column in cursor.description)
+        yield cls(first)
+        for row in rows:
+            yield cls(row)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""
+Keep dedupe_ids stable from one run to the next.
+
+The ids that come out of clustering are _unique_ids, which are regenerated every time
+preprocess runs. The entity registry remembers which dedupe_id each source key had in
+the previous run, so that new clusters can take over the id of the old cluster they
+share the most members with.
+"""
+import logging
+
+
+def assign_stable_ids(con, config):
+    """Replace the dedupe_ids in unique_map with ids that are stable across runs
+
+    Every new cluster is matched to the previous run's entity it shares the most source
+    keys with; each previous id is given to at most one new cluster, the one with the
+    largest overlap. Clusters without a match get a fresh id from the entity_id_seq
+    sequence. The registry is then replaced by the new mapping.
+
+    Creates or updates the following tables:
+    entity_registry (key -> entity id of the latest run), entity_overlap and
+    entity_id_map (new cluster id -> stable id)
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+    """
+    c = con.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS {schema}.entity_registry AS "
+              "SELECT {key}, dedupe_id AS entity_id FROM {schema}.unique_map "
+              "LIMIT 0".format(**config))
+    c.execute("CREATE SEQUENCE IF NOT EXISTS {schema}.entity_id_seq".format(**config))
+    # Never hand out an id that the registry already uses
+    c.execute("SELECT setval('{schema}.entity_id_seq', max(entity_id)) "
+              "FROM {schema}.entity_registry "
+              "HAVING max(entity_id) > (SELECT last_value FROM {schema}.entity_id_seq)"
+              .format(**config))
+
+    logging.info("calculating {schema}.entity_overlap".format(**config))
+    c.execute("DROP TABLE IF EXISTS {schema}.entity_overlap".format(**config))
+    c.execute("CREATE TABLE {schema}.entity_overlap AS "
+              "SELECT m.dedupe_id AS new_id, r.entity_id AS old_id, count(*) AS overlap "
+              "FROM {schema}.unique_map m INNER JOIN {schema}.entity_registry r USING ({key}) "
+              "GROUP BY m.dedupe_id, r.entity_id".format(**config))
+
+    # Each old id goes to the new cluster that overlaps it most, and each new cluster then
+    # keeps the best of the old ids it was offered. Ties go to the smallest id.
+    logging.info("calculating {schema}.entity_id_map".format(**config))
+    c.execute("DROP TABLE IF EXISTS {schema}.entity_id_map".format(**config))
+    c.execute("CREATE TABLE {schema}.entity_id_map AS "
+              "SELECT DISTINCT ON (new_id) new_id, old_id AS entity_id FROM ("
+              " SELECT DISTINCT ON (old_id) new_id, old_id, overlap "
+              " FROM {schema}.entity_overlap ORDER BY old_id, overlap DESC, new_id) o "
+              "ORDER BY new_id, overlap DESC, old_id".format(**config))
+    c.execute("SELECT count(*) AS n FROM {schema}.entity_id_map".format(**config))
+    num_kept = c.fetchone()['n']
+    c.execute("INSERT INTO {schema}.entity_id_map "
+              "SELECT new_id, nextval('{schema}.entity_id_seq') FROM ("
+              " SELECT DISTINCT dedupe_id AS new_id FROM {schema}.unique_map m "
+              " WHERE NOT EXISTS (SELECT 1 FROM {schema}.entity_id_map e "
+              "                   WHERE e.new_id = m.dedupe_id) "
+              " ORDER BY new_id) s".format(**config))
+    num_new = c.rowcount
+    c.execute("CREATE UNIQUE INDEX entity_id_map_idx "
+              "ON {schema}.entity_id_map (new_id)".format(**config))
+    logging.info("%s entities kept their id, %s got a new one", num_kept, num_new)
+
+    c.execute("UPDATE {schema}.unique_map m SET dedupe_id = e.entity_id "
+              "FROM {schema}.entity_id_map e WHERE m.dedupe_id = e.new_id".format(**config))
+    c.execute("UPDATE {schema}.entries_unique u SET dedupe_id = m.dedupe_id "
+              "FROM {schema}.unique_map m WHERE m.{key} = u.src_ids[1]".format(**config))
+
+    c.execute("DROP TABLE {schema}.entity_registry".format(**config))
+    c.execute("CREATE TABLE {schema}.entity_registry AS "
+              "SELECT {key}, dedupe_id AS entity_id FROM {schema}.unique_map".format(**config))
+    c.execute("CREATE UNIQUE INDEX entity_registry_key_idx "
+              "ON {schema}.entity_registry ({key})".format(**config))
+    con.commit()
+    c.close()
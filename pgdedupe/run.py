@@ -3,11 +3,29 @@ import csv
 import tempfile
 import logging
 import random
+import importlib
+import threading
+import multiprocessing
 import numpy
+import pandas as pd
 import dedupe
-import importlib
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
 
 from . import exact_matches
+from . import components
+from . import registry
+from . import instrument
+from .records import compact_rows
+from .progress import Progress, count_rows
+from .diagnostics import statement_cursor
+from .session import PROFILES, apply_settings
+from .utils import prefetch
+
+
+class BlockingError(ValueError):
+    """No pair of records was blocked together, so there is nothing to score"""
 
 
 def process_options(user_config):
@@ -21,10 +39,26 @@ def process_options(user_config):
     """
     config = dict()
     # Required fields
-    for k in ('schema', 'table', 'key', 'fields'):
+    for k in ('schema', 'key', 'fields'):
         if k not in user_config:
             raise Exception('Key ' + k + ' must be defined in the config file')
         config[k] = user_config[k]
+    # Either the table to deduplicate or the two tables to link
+    config['linkage'] = 'left_table' in user_config or 'right_table' in user_config
+    if config['linkage']:
+        required = ('left_table', 'right_table')
+    elif 'input_file' in user_config:
+        # Local files are deduplicated without any table (see files.run_files)
+        required = ()
+    else:
+        required = ('table',)
+    for k in required:
+        if k not in user_config:
+            raise Exception('Key ' + k + ' must be defined in the config file')
+    if config['linkage'] and 'table' in user_config:
+        raise Exception('table cannot be used with left_table and right_table')
+    for k in ('table', 'left_table', 'right_table'):
+        config[k] = user_config.get(k)
     # Optional fields
     for k, default in (('interactions', []),
                        ('threshold', 0.5),
@@ -38,14 +72,62 @@ def process_options(user_config):
                        ('num_cores', None),
                        ('use_saved_model', False),
                        ('prompt_for_labels', True),
-                       ('seed', None)
+                       ('seed', None),
+                       ('plan_sample_blocks', 1000),
+                       ('cluster_workers', 1),
+                       ('persist_scores', False),
+                       ('checkpoint_ranges', None),
+                       ('write_batch_size', 100000),
+                       ('compact_records', False),
+                       ('train_itersize', 2000),
+                       ('index_itersize', 2000),
+                       ('blocking_itersize', 2000),
+                       ('cluster_itersize', 2000),
+                       ('prefetch_blocks', 0),
+                       ('clustering', 'hierarchical'),
+                       ('max_hierarchical_size', None),
+                       ('clustering_workers', 1),
+                       ('apply_mode', 'update'),
+                       ('apply_batch_size', 100000),
+                       ('stable_ids', False),
+                       ('apply_workers', 1),
+                       ('run_report', None),
+                       ('progress_interval', 60),
+                       ('progress_file', None),
+                       ('record_statements', False),
+                       ('explain_statements', False),
+                       ('session_profile', None),
+                       ('session_settings', {}),
+                       ('partition_by', None),
+                       ('partition_workers', 1),
+                       ('input_file', None),
+                       ('output_file', 'entity_map.csv'),
+                       ('work_dir', None)
                        ):
         config[k] = user_config.get(k, default)
+    if config['clustering'] not in ('hierarchical', 'connected_components'):
+        raise Exception('clustering must be either hierarchical or connected_components')
+    if config['session_profile'] and config['session_profile'] not in PROFILES:
+        raise Exception('session_profile must be one of ' + ', '.join(sorted(PROFILES)))
+    if config['apply_mode'] not in ('update', 'map_table', 'swap', 'diff', 'chunked'):
+        raise Exception('apply_mode must be one of update, map_table, swap, diff or chunked')
+    # Without stable ids nearly every dedupe_id changes, so a diff would rewrite every row
+    if config['apply_mode'] == 'diff' and not config['stable_ids']:
+        raise Exception('apply_mode diff requires stable_ids')
     # Ensure that the merge_exact list is a list of lists
     if type(config['merge_exact']) is not list:
         raise Exception('merge_exact must be a list of columns')
     if len(config['merge_exact']) > 0 and type(config['merge_exact'][0]) is not list:
         config['merge_exact'] = [config['merge_exact']]
+    if config['linkage']:
+        if config['apply_mode'] not in ('update', 'map_table'):
+            raise Exception('apply_mode must be either update or map_table '
+                            'with left_table and right_table')
+        if config['stable_ids']:
+            raise Exception('stable_ids cannot be used with left_table and right_table')
+        field_names = [d['field'] for d in config['fields']]
+        if any(c not in field_names for cols in config['merge_exact'] for c in cols):
+            raise Exception('merge_exact can only use fields with left_table and right_table')
     # Add variable names to the field definitions, defaulting to the field
     for d in config['fields']:
         if 'variable name' not in d:
@@ -56,25 +138,44 @@ def process_options(user_config):
     columns = set([x['field'] for x in config['fields']])
     config['columns'] = ', '.join(columns)
     config['all_columns'] = ', '.join(columns | set(['_unique_id']))
+    if config['linkage']:
+        # Which table each record of entries_unique came from: 0 for left, 1 for right
+        config['all_columns'] += ', _source'
     return config
 
 
-def preprocess(con, config):
-    """Prepare the database for a deduping run
+def named_cursor(con, config, name, stage):
+    """Open a server-side cursor for streaming records out of the database
 
-    Creates necessary schemas and database functions,
-    as well as performing an exact-duplicate merge.
-
-    When the function is done, there will be an 'entries_unique' table
-    with the results of the exact-duplicate merge
+    If config['compact_records'] is set, the cursor returns plain tuples to be wrapped by
+    fetch_records instead of a dict per row.
 
     Args:
         con (psycopg2.connection)
         config (dict) configuration options for a deduping run. Expected to have defaults applied
+        name (str) name of the server-side cursor
+        stage (str) one of 'train', 'index', 'blocking' or 'cluster'; the cursor fetches
+            config['<stage>_itersize'] rows from the server at a time
+
+    Returns: (psycopg2.cursor)
     """
-    c = con.cursor()
+    if config['compact_records']:
+        cur = con.cursor(name, cursor_factory=psycopg2.extensions.cursor)
+    else:
+        cur = con.cursor(name)
+    cur.itersize = config[stage + '_itersize']
+    return cur
 
-    # Ensure the database has the schema and required functions
+
+def fetch_records(cursor, config):
+    """Iterate over the rows of a cursor from named_cursor as records keyed by column name"""
+    if config['compact_records']:
+        return compact_rows(cursor)
+    return cursor
+
+
+def create_schema(c, config):
+    """Ensure the database has the schema and required functions"""
     c.execute("""CREATE SCHEMA IF NOT EXISTS {schema}""".format(**config))
 
     # Create an intarray-like idx function (https://wiki.postgresql.org/wiki/Array_Index):
@@ -88,18 +189,58 @@ def preprocess(con, config):
                    LIMIT 1;
                  $$ LANGUAGE SQL IMMUTABLE;""".format(**config))
 
+
+def preprocess(con, config):
+    """Prepare the database for a deduping run
+
+    Creates necessary schemas and database functions,
+    as well as performing an exact-duplicate merge.
+
+    When the function is done, there will be an 'entries_unique' table
+    with the results of the exact-duplicate merge
+
+    If config['partition_by'] is set, that column is kept in entries_unique too, so that
+    exact duplicates are only merged within a partition.
+
+    When linking config['left_table'] to config['right_table'], the records of both are
+    combined into entries_unique with a _source column, 0 for the left table and 1 for the
+    right. Exact duplicates are only merged within a table.
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+    """
+    c = con.cursor()
+    create_schema(c, config)
+
+    group_columns = config['columns']
+    if config['partition_by'] and config['partition_by'] not in [f['field'] for f in
+                                                                 config['fields']]:
+        group_columns += ', ' + config['partition_by']
+
+    if config['linkage']:
+        source = ("(SELECT {group_columns}, {key}, 0 AS _source FROM {left_table} "
+                  " WHERE ({filter_condition}) "
+                  " UNION ALL "
+                  " SELECT {group_columns}, {key}, 1 AS _source FROM {right_table} "
+                  " WHERE ({filter_condition})) AS linked").format(
+                      group_columns=group_columns, **config)
+        group_columns += ', _source'
+    else:
+        source = "{table} WHERE ({filter_condition})".format(**config)
+
     # Do an initial first pass and merge all exact duplicates
     c.execute("""DROP TABLE IF EXISTS {schema}.entries_unique""".format(**config))
     c.execute("""CREATE TABLE {schema}.entries_unique AS (
-                    SELECT {columns}, array_agg({key}) as src_ids FROM {table}
-                    WHERE ({filter_condition})
-                    GROUP BY {columns})""".format(**config))
+                    SELECT {group_columns}, array_agg({key}) as src_ids FROM {source}
+                    GROUP BY {group_columns})""".format(group_columns=group_columns,
+                                                        source=source, **config))
     c.execute("ALTER TABLE {schema}.entries_unique "
               " ADD COLUMN _unique_id SERIAL PRIMARY KEY".format(**config))
     con.commit()
 
 
-def train(con, config):
+def train(con, config, records=None):
     """Trains or retrieves a previously trained Dedupe object
 
     If config['use_saved_model'] is set, it will read the saved model from
@@ -111,11 +252,16 @@ def train(con, config):
     If config['prompt_for_labels'] is set, the console will be used to ask the user to
     help label examples
 
+    When linking two tables, a dedupe.RecordLink is trained on pairs of one record from
+    each table instead.
+
     Args:
         con (psycopg2.connection)
         config (dict) configuration options for a deduping run. Expected to have defaults applied
+        records (dict) optionally, the records to sample from by id, instead of the records
+            of entries_unique
 
-    Returns: (dedupe.Dedupe or dedupe.StaticDedupe)
+    Returns: (dedupe.Dedupe or dedupe.StaticDedupe, or their RecordLink counterparts)
     """
     if config['seed'] is not None:
         if os.environ.get('PYTHONHASHSEED', 'random') == 'random':
@@ -126,28 +272,38 @@ def train(con, config):
     if config['use_saved_model']:
         logging.info('reading saved model from %s', config['settings_file'])
         with open(config['settings_file'], 'rb') as sf:
-            return dedupe.StaticDedupe(sf, num_cores=config['num_cores'])
+            return static_model(sf, config, config['num_cores'])
     # Create a new deduper object and pass our data model to it.
-    deduper = dedupe.Dedupe(config['all_fields'], num_cores=config['num_cores'])
+    model = dedupe.RecordLink if config['linkage'] else dedupe.Dedupe
+    deduper = model(config['all_fields'], num_cores=config['num_cores'])
 
     module_name, class_name = config['classifier'].rsplit(".", 1)
     module = importlib.import_module(module_name)
     cls = getattr(module, class_name)
     deduper.classifier = cls(**config['hyperparameters'])
 
-    # Named cursor runs server side with psycopg2
-    cur = con.cursor('individual_select')
-
-    cur.execute("""SELECT {all_columns}
-                   FROM {schema}.entries_unique
-                   ORDER BY _unique_id""".format(**config))
-    temp_d = dict((i, row) for i, row in enumerate(cur))
-
     num_records = 75000
     logging.info('Creating sample of %s records', num_records)
-    deduper.sample(temp_d, num_records)
+    if records is not None:
+        deduper.sample(records, num_records)
+    else:
+        # Named cursor runs server side with psycopg2
+        cur = con.cursor('individual_select')
+        cur.itersize = config['train_itersize']
+
+        cur.execute("""SELECT {all_columns}
+                       FROM {schema}.entries_unique
+                       ORDER BY _unique_id""".format(**config))
+        if config['linkage']:
+            temp_d = ({}, {})
+            for i, row in enumerate(cur):
+                temp_d[row['_source']][i] = row
+            deduper.sample(temp_d[0], temp_d[1], num_records)
+        else:
+            temp_d = dict((i, row) for i, row in enumerate(cur))
+            deduper.sample(temp_d, num_records)
 
-    del temp_d
+        del temp_d
     # If we have training data saved from a previous run of dedupe,
     # look for it an load it in.
     #
@@ -183,7 +339,59 @@ def train(con, config):
     return deduper
 
 
+def static_model(sf, config, num_cores):
+    """Read a model saved by train from an open settings file
+
+    Returns: (dedupe.StaticRecordLink) when linking two tables, otherwise
+        (dedupe.StaticDedupe)
+    """
+    model = dedupe.StaticRecordLink if config['linkage'] else dedupe.StaticDedupe
+    return model(sf, num_cores=num_cores)
+
+
 # Blocking
+def predicate_fields(predicates):
+    """Find the record fields that a set of dedupe blocking predicates read
+
+    Args:
+        predicates (iterable) simple or compound dedupe predicates
+
+    Returns: (set of str) the field names, or None if a predicate does not name its field
+    """
+    fields = set()
+    for predicate in predicates:
+        if isinstance(predicate, tuple):
+            # Compound predicates are tuples of simpler predicates
+            sub_fields = predicate_fields(predicate)
+            if sub_fields is None:
+                return None
+            fields |= sub_fields
+        elif hasattr(predicate, 'field'):
+            fields.add(predicate.field)
+        else:
+            return None
+    return fields
+
+
+def blocking_columns(deduper, config):
+    """The columns of entries_unique that blocking needs to read
+
+    Only the fields used by the learned predicates are selected, falling back to all of
+    the configured fields if they cannot be determined.
+
+    Args:
+        deduper (dedupe.Dedupe or dedupe.StaticDedupe) A trained Dedupe object
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+
+    Returns: (str) a comma-separated column list, always including _unique_id
+    """
+    fields = predicate_fields(deduper.blocker.predicates)
+    available = set(f['field'] for f in config['fields'])
+    if fields is None or not fields <= available:
+        return config['all_columns']
+    return ', '.join(sorted(fields) + ['_unique_id'])
+
+
 def create_blocking(deduper, con, config):
     """Runs blocking on a deduper object to prepare data for matchBlocks
 
@@ -193,6 +401,8 @@ def create_blocking(deduper, con, config):
     The following tables are created:
     blocking_map, plural_key, plural_blocks, covered_blocks, smaller_coverage
 
+    When linking two tables, only blocks with records from both are kept.
+
     smaller_coverage is roughly the format that deduper.matchBlocks requires. The other tables
     are considered intermediate tables.
 
@@ -211,13 +421,15 @@ def create_blocking(deduper, con, config):
               "(block_key VARCHAR(200), _unique_id INT)".format(**config))
 
     # If dedupe learned a Index Predicate, we have to take a pass
-    # through the data and create indices.
+    # through the data and create indices. When linking two tables, like
+    # dedupe.RecordLink, only the records of the right table are indexed.
     print('creating inverted index')
 
     for field in deduper.blocker.index_fields:
-        c2 = con.cursor('c2')
-        c2.execute("SELECT DISTINCT {0} FROM {schema}.entries_unique".format(field, **config))
-        field_data = (row[field] for row in c2)
+        c2 = named_cursor(con, config, 'c2', 'index')
+        c2.execute("SELECT DISTINCT {0} FROM {schema}.entries_unique{1}".format(
+            field, ' WHERE _source = 1' if config['linkage'] else '', **config))
+        field_data = (row[field] for row in fetch_records(c2, config))
         deduper.blocker.index(field_data, field)
         c2.close()
 
@@ -225,10 +437,15 @@ def create_blocking(deduper, con, config):
     # generator that yields unique `(block_key, donor_id)` tuples.
     print('writing blocking map')
 
-    c3 = con.cursor('donor_select2')
-    c3.execute("SELECT {all_columns} FROM {schema}.entries_unique".format(**config))
-    full_data = ((row['_unique_id'], row) for row in c3)
-    b_data = deduper.blocker(full_data)
+    c3 = named_cursor(con, config, 'donor_select2', 'blocking')
+    c3.execute("SELECT {0} FROM {schema}.entries_unique".format(
+        blocking_columns(deduper, config), **config))
+    progress = Progress('blocking records',
+                        count_rows(con, '{schema}.entries_unique'.format(**config)),
+                        config, 'records')
+    full_data = ((row['_unique_id'], row)
+                 for row in progress.track(fetch_records(c3, config)))
+    b_data = instrument.counted(deduper.blocker(full_data), 'block_keys')
 
     # Write out blocking map to CSV so we can quickly load in with
     # Postgres COPY
@@ -270,9 +487,17 @@ def create_blocking(deduper, con, config):
               "(block_key VARCHAR(200), "
               " block_id SERIAL PRIMARY KEY)".format(**config))
 
-    c.execute("INSERT INTO {schema}.plural_key (block_key) "
-              "SELECT block_key FROM {schema}.blocking_map "
-              "GROUP BY block_key HAVING COUNT(*) > 1".format(**config))
+    if config['linkage']:
+        # Only records from different tables are compared, so a block also needs a
+        # record from each of them
+        c.execute("INSERT INTO {schema}.plural_key (block_key) "
+                  "SELECT block_key FROM {schema}.blocking_map "
+                  "INNER JOIN {schema}.entries_unique USING (_unique_id) "
+                  "GROUP BY block_key HAVING COUNT(DISTINCT _source) = 2".format(**config))
+    else:
+        c.execute("INSERT INTO {schema}.plural_key (block_key) "
+                  "SELECT block_key FROM {schema}.blocking_map "
+                  "GROUP BY block_key HAVING COUNT(*) > 1".format(**config))
 
     logging.info("creating {schema}.block_key index".format(**config))
     c.execute("CREATE UNIQUE INDEX block_key_idx "
@@ -332,51 +557,560 @@ def candidates_gen(result_set):
     Yields:
         Records in form (unique id, row, smaller block ids)
     """
-    lset = set
+    # Smaller block ids are immutable, so equal ones within a block share one
+    # frozenset, and all records without any share the same empty one
+    empty = frozenset()
 
     block_id = None
     records = []
-    i = 0
+    shared_ids = {}
     for row in result_set:
         if row['block_id'] != block_id:
             if records:
+                instrument.count('blocks')
+                instrument.count('block_records', len(records))
                 yield records
 
             block_id = row['block_id']
             records = []
-            i += 1
+            shared_ids = {}
 
         smaller_ids = row['smaller_ids']
 
         if smaller_ids:
-            smaller_ids = lset(smaller_ids)
+            key = tuple(smaller_ids)
+            smaller_ids = shared_ids.get(key)
+            if smaller_ids is None:
+                smaller_ids = shared_ids[key] = frozenset(key)
         else:
-            smaller_ids = lset([])
+            smaller_ids = empty
 
         records.append((row['_unique_id'], row, smaller_ids))
 
     if records:
+        instrument.count('blocks')
+        instrument.count('block_records', len(records))
         yield records
 
 
-def cluster(deduper, con, config):
+def link_blocks(blocks):
+    """Split each block from candidates_gen into its records from the left and right tables
+
+    Yields: (left records, right records) tuples, the blocks dedupe.RecordLink expects
+    """
+    for block in blocks:
+        yield ([record for record in block if record[1]['_source'] == 0],
+               [record for record in block if record[1]['_source'] == 1])
+
+
+def link_clusters(matches):
+    """Write the pairs matched one-to-one by dedupe.RecordLink as clusters of two records
+
+    Args:
+        matches (iterable of (pair, score) tuples) as yielded by dedupe.RecordLink.matchBlocks
+            or dedupe.clustering.greedyMatching
+
+    Yields: (cluster_id, scores) tuples, in the format of dedupe's clustering
+    """
+    for pair, score in matches:
+        yield pair, (score, score)
+
+
+def block_ranges(con, config, n):
+    """Split the plural blocks into contiguous block_id ranges of similar work
+
+    Ranges are balanced by the number of record pairs within their blocks rather than the
+    number of blocks, since a few large blocks usually dominate.
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        n (int) the maximum number of ranges
+
+    Returns: (list of (int, int) tuples) inclusive lower and upper block_ids, in order
+    """
+    c = con.cursor()
+    c.execute("SELECT min(block_id) AS lo, max(block_id) AS hi FROM ("
+              " SELECT block_id, "
+              " floor((sum(pairs) OVER (ORDER BY block_id) - pairs) * %s "
+              "       / sum(pairs) OVER ()) AS part "
+              " FROM (SELECT block_id, count(*)::BIGINT * (count(*) - 1) / 2 AS pairs "
+              "       FROM {schema}.plural_block GROUP BY block_id) b) s "
+              "GROUP BY part ORDER BY lo".format(**config), (n,))
+    ranges = [(row['lo'], row['hi']) for row in c.fetchall()]
+    c.close()
+    return ranges
+
+
+def count_blocks(con, config, ranges):
+    """Count the plural blocks within block_id ranges, such as those left to score when
+    resuming a checkpointed run
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        ranges (list of (int, int) tuples) inclusive block_id ranges, or [None] for all blocks
+
+    Returns: (int) the number of blocks
+    """
+    if ranges == [None]:
+        return count_rows(con, '{schema}.plural_key'.format(**config))
+    c = con.cursor()
+    c.execute("SELECT count(*) AS n FROM {schema}.plural_key "
+              "INNER JOIN unnest(%s::INT[], %s::INT[]) AS r(lo, hi) "
+              "ON block_id BETWEEN r.lo AND r.hi".format(**config),
+              ([lo for lo, _ in ranges], [hi for _, hi in ranges]))
+    n = c.fetchone()['n']
+    c.close()
+    return n
+
+
+def select_blocks(con, config, name, block_range=None):
+    """Open a named cursor over the blocked records, sorted by block_id
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        name (str) name of the server-side cursor
+        block_range (tuple of int) optional inclusive lower and upper block_ids to select
+
+    Returns: (psycopg2.cursor) to be passed to read_blocks
+    """
+    where, params = '', None
+    if block_range is not None:
+        where, params = "WHERE block_id BETWEEN %s AND %s ", block_range
+    cur = named_cursor(con, config, name, 'cluster')
+    cur.execute("SELECT {all_columns}, block_id, NULLIF(smaller_ids, '{{}}') AS smaller_ids "
+                "FROM {schema}.smaller_coverage "
+                "INNER JOIN {schema}.entries_unique "
+                "USING (_unique_id) ".format(**config) + where +
+                "ORDER BY (block_id)", params)
+    return cur
+
+
+def read_blocks(cursor, config):
+    """Group the rows of a cursor from select_blocks into blocks with candidates_gen
+
+    If config['prefetch_blocks'] is set, up to that many blocks are fetched and grouped
+    ahead on a background thread, so the database and the scoring can work at the same time.
+
+    When linking two tables, the blocks are split with link_blocks.
+    """
+    blocks = candidates_gen(fetch_records(cursor, config))
+    if config['linkage']:
+        blocks = link_blocks(blocks)
+    if config['prefetch_blocks']:
+        return prefetch(blocks, config['prefetch_blocks'])
+    return blocks
+
+
+def score_blocks(deduper, blocks, num_cores=1):
+    """Score every candidate pair of records within the given blocks
+
+    This is the scoring half of dedupe.Dedupe.matchBlocks.
+
+    Args:
+        deduper (dedupe.Dedupe or dedupe.StaticDedupe) A trained Dedupe object
+        blocks (iterable) Blocks of records, as yielded by candidates_gen
+        num_cores (int) number of processes dedupe may use for scoring
+
+    Returns: (numpy structured array) with the record id 'pairs' and their 'score', in
+        memory, or None if there were no pairs to score
+    """
+    first, blocks = dedupe.core.peek(blocks)
+    if first is None:
+        return None
+    # _blockedPairs chains the pairs of all blocks into one iterator
+    scores = dedupe.core.scoreDuplicates(deduper._blockedPairs(blocks), deduper.data_model,
+                                         deduper.classifier, num_cores, threshold=0)
+    # dedupe returns an empty list rather than an array if every pair was redundant
+    if len(scores) == 0:
+        return None
+    if isinstance(scores, numpy.memmap):
+        # Copy out of dedupe's temporary file and remove it, as matchBlocks does
+        filename = scores.filename
+        scores = numpy.array(scores)
+        os.remove(filename)
+    return scores
+
+
+def sort_scores(scores):
+    """Order scored pairs by their record ids so clustering does not depend on scoring order"""
+    return scores[numpy.lexsort((scores['pairs'][:, 1], scores['pairs'][:, 0]))]
+
+
+def score_block_range(args):
+    """Score a range of blocks in a worker process with its own connection and deduper
+
+    Args:
+        args (tuple) database credentials, configuration options and an inclusive block_id
+            range. Packed in one tuple for use with multiprocessing.Pool.imap
+
+    Returns: (numpy structured array) the scored pairs, or None if there were none, and
+        (dict) the worker's counters, for instrument.merge_counters
+    """
+    dbconfig, config, block_range = args
+    con = psycopg2.connect(cursor_factory=statement_cursor(config), **dbconfig)
+    apply_settings(con, config, 'cluster')
+    with open(config['settings_file'], 'rb') as sf:
+        deduper = static_model(sf, config, 1)
+    with instrument.worker_counters() as counters:
+        c4 = select_blocks(con, config, 'c4_{}'.format(block_range[0]), block_range)
+        scores = score_blocks(deduper, read_blocks(c4, config))
+    c4.close()
+    con.close()
+    logging.info('scored blocks %s to %s', *block_range)
+    return scores, counters
+
+
+def score_ranges(deduper, con, config, ranges, dbconfig=None):
+    """Score ranges of blocks, in worker processes if config['cluster_workers'] is above one
+
+    Each worker opens its own connection and reads the saved model from
+    config['settings_file']. Otherwise, the blocks are scored here with a single cursor.
+
+    Args:
+        deduper (dedupe.Dedupe or dedupe.StaticDedupe) A trained Dedupe object
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        ranges (list of (int, int) tuples) inclusive block_id ranges, or None for all blocks
+        dbconfig (dict) database connection credentials, required for worker processes
+
+    Yields: (numpy structured array) the scored pairs of each range in the order given,
+        or None if a range had no pairs
+    """
+    if config['cluster_workers'] > 1:
+        if dbconfig is None:
+            raise Exception('cluster_workers requires the database credentials')
+        progress = Progress('scoring block ranges', len(ranges), config, 'block ranges')
+        pool = multiprocessing.Pool(config['cluster_workers'])
+        try:
+            for scores, counters in progress.track(
+                    pool.imap(score_block_range, [(dbconfig, config, r) for r in ranges])):
+                instrument.merge_counters(counters)
+                yield scores
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        progress = Progress('scoring blocks', count_blocks(con, config, ranges),
+                            config, 'blocks')
+        for block_range in ranges:
+            c4 = select_blocks(con, config, 'c4', block_range)
+            blocks = progress.track(read_blocks(c4, config))
+            scores = score_blocks(deduper, blocks, deduper.num_cores)
+            c4.close()
+            yield scores
+
+
+def create_scores_table(con, config):
+    """(Re)create the empty scored_pairs table"""
+    c = con.cursor()
+    c.execute("DROP TABLE IF EXISTS {schema}.scored_pairs".format(**config))
+    c.execute("CREATE TABLE {schema}.scored_pairs "
+              "(_unique_id_1 INT, _unique_id_2 INT, score FLOAT)".format(**config))
+    c.close()
+
+
+def copy_scores(scores, con, config):
+    """Append scored pairs to the scored_pairs table with a bulk COPY"""
+    c = con.cursor()
+    with tempfile.TemporaryFile(mode='w+t') as f:
+        numpy.savetxt(f, numpy.column_stack((scores['pairs'], scores['score'])),
+                      fmt=('%d', '%d', '%.9g'), delimiter=',')
+        f.seek(0)
+        c.copy_expert("COPY {schema}.scored_pairs FROM STDIN CSV".format(**config), f)
+    c.close()
+
+
+def write_scores(scores, con, config):
+    """Write scored pairs to the scored_pairs table with a bulk COPY
+
+    Args:
+        scores (numpy structured array) scored pairs, as returned by score_blocks
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+    """
+    create_scores_table(con, config)
+    copy_scores(scores, con, config)
+    con.commit()
+
+
+def checkpoint_ranges(con, config, resume=False):
+    """Find the block_id ranges that still have to be scored in a checkpointed run
+
+    A new run splits the blocks into config['checkpoint_ranges'] ranges, records them in
+    the cluster_checkpoints table and empties scored_pairs. A resumed run picks up the
+    ranges of the previous run that were not completed.
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        resume (bool) continue the previous run instead of starting over
+
+    Returns: (list of (int, int) tuples) inclusive block_id ranges, in order
+    """
+    c = con.cursor()
+    if not resume:
+        c.execute("DROP TABLE IF EXISTS {schema}.cluster_checkpoints".format(**config))
+        c.execute("CREATE TABLE {schema}.cluster_checkpoints "
+                  "(lo INT PRIMARY KEY, hi INT, completed_at TIMESTAMP)".format(**config))
+        c.executemany("INSERT INTO {schema}.cluster_checkpoints (lo, hi) "
+                      "VALUES (%s, %s)".format(**config),
+                      block_ranges(con, config, config['checkpoint_ranges']))
+        create_scores_table(con, config)
+        con.commit()
+    c.execute("SELECT lo, hi FROM {schema}.cluster_checkpoints "
+              "WHERE completed_at IS NULL ORDER BY lo".format(**config))
+    ranges = [(row['lo'], row['hi']) for row in c.fetchall()]
+    c.close()
+    return ranges
+
+
+def score_checkpointed(deduper, con, config, dbconfig=None, resume=False):
+    """Score all blocks, committing the scored pairs of each block_id range as it completes
+
+    If the run is interrupted, it can be resumed from the ranges that were not committed.
+
+    Args:
+        deduper (dedupe.Dedupe or dedupe.StaticDedupe) A trained Dedupe object
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        dbconfig (dict) database connection credentials, required for worker processes
+        resume (bool) continue the previous run instead of starting over
+
+    Returns: (numpy structured array) the scored pairs of all blocks, sorted by record ids
+    """
+    ranges = checkpoint_ranges(con, config, resume)
+    logging.info('%s block ranges to score', len(ranges))
+    c = con.cursor()
+    # The generator comes first so zip exhausts it and the worker pool is cleaned up
+    for scores, block_range in zip(score_ranges(deduper, con, config, ranges, dbconfig),
+                                   ranges):
+        if scores is not None:
+            copy_scores(scores, con, config)
+        c.execute("UPDATE {schema}.cluster_checkpoints SET completed_at = now() "
+                  "WHERE lo = %s".format(**config), (block_range[0],))
+        con.commit()
+        logging.info('committed blocks %s to %s', *block_range)
+    c.close()
+    return read_scores(con, config)
+
+
+def read_scores(con, config, min_score=0):
+    """Read scored pairs back from the scored_pairs table
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        min_score (float) only read pairs that score above this
+
+    Returns: (numpy structured array) with the record id 'pairs' and their 'score', sorted
+        by record ids, in the format dedupe's clustering expects
+    """
+    c = con.cursor()
+    with tempfile.TemporaryFile(mode='w+t') as f:
+        c.copy_expert(c.mogrify("COPY (SELECT _unique_id_1, _unique_id_2, score "
+                                "FROM {schema}.scored_pairs WHERE score > %s) "
+                                "TO STDOUT CSV".format(**config), (min_score,)).decode(), f)
+        f.seek(0)
+        pairs = pd.read_csv(f, header=None, names=['id1', 'id2', 'score'])
+    c.close()
+    scores = numpy.empty(len(pairs), dtype=[('pairs', 'i8', 2), ('score', 'f4')])
+    scores['pairs'][:, 0] = pairs['id1'].values
+    scores['pairs'][:, 1] = pairs['id2'].values
+    scores['score'] = pairs['score'].values
+    return sort_scores(scores)
+
+
+def cluster_component(args):
+    """Cluster the scored pairs of one component hierarchically in a worker process
+
+    Args:
+        args (tuple) the component's scored pairs and the clustering threshold. Packed in
+            one tuple for use with multiprocessing.Pool.imap
+
+    Returns: (list of (cluster_id, scores) tuples)
+    """
+    component, threshold = args
+    return list(dedupe.clustering.cluster(component, threshold))
+
+
+def cluster_components_parallel(parts, threshold, workers):
+    """Cluster independent components hierarchically in a pool of worker processes
+
+    The largest components are started first, so they do not end up as the long tail of
+    the run. The clusters are yielded in that same order (by decreasing number of pairs,
+    then by smallest record id), so the results do not depend on scheduling.
+
+    Args:
+        parts (list of numpy structured arrays) the scored pairs of each component, ordered
+            by their smallest record id
+        threshold (float) the clustering threshold
+        workers (int) the number of worker processes
+
+    Yields: (cluster_id, scores) tuples, in the format of dedupe's clustering
+    """
+    order = numpy.argsort([-len(part) for part in parts], kind='mergesort')
+    pool = multiprocessing.Pool(workers)
+    try:
+        for clusters in pool.imap(cluster_component,
+                                  [(parts[i], threshold) for i in order],
+                                  chunksize=16):
+            for cluster in clusters:
+                yield cluster
+    finally:
+        pool.close()
+        pool.join()
+
+
+def hierarchical_clusters(scores, threshold, workers=1):
+    """Cluster scored pairs with dedupe's hierarchical clustering
+
+    With more than one worker, the scored pairs are split into their connected components,
+    which are independent, and clustered in parallel (see cluster_components_parallel).
+    This gives the same clusters as clustering them all at once.
+
+    Args:
+        scores (numpy structured array) scored pairs, as returned by score_blocks or read_scores
+        threshold (float) the clustering threshold
+        workers (int) the number of worker processes
+
+    Returns: (generator of (cluster_id, scores) tuples)
+    """
+    if workers > 1:
+        return cluster_components_parallel(components.split_components(scores),
+                                           threshold, workers)
+    return dedupe.clustering.cluster(scores, threshold)
+
+
+def connected_component_clusters(scores, threshold, max_hierarchical_size=None, workers=1):
+    """Cluster scored pairs by the connected components of the pairs above the threshold
+
+    This skips dedupe's hierarchical clustering, whose cost is dominated by a few giant
+    components. Components with fewer than max_hierarchical_size records are still
+    clustered hierarchically, in parallel if there is more than one worker.
+
+    Args:
+        scores (numpy structured array) scored pairs, as returned by score_blocks or read_scores
+        threshold (float) the clustering threshold
+        max_hierarchical_size (int) optional size limit for hierarchical clustering
+        workers (int) the number of worker processes for hierarchical clustering
+
+    Yields: (cluster_id, scores) tuples, in the format of dedupe's clustering
+    """
+    small = []
+    for component in components.split_components(scores[scores['score'] > threshold]):
+        if (max_hierarchical_size and
+                len(numpy.unique(component['pairs'])) < max_hierarchical_size):
+            small.append(component)
+        else:
+            yield components.component_cluster(component)
+    if workers > 1 and small:
+        for cluster in cluster_components_parallel(small, threshold, workers):
+            yield cluster
+    else:
+        for component in small:
+            for cluster in dedupe.clustering.cluster(component, threshold):
+                yield cluster
+
+
+def cluster_scores(scores, config):
+    """Cluster scored pairs at config['threshold']
+
+    With config['clustering'] set to 'hierarchical' (the default), dedupe's hierarchical
+    clustering is used. With 'connected_components', see connected_component_clusters.
+    Hierarchical clustering is run per component in config['clustering_workers'] processes
+    if that is more than one. When linking two tables, the pairs are matched one-to-one
+    with dedupe's greedy matching instead.
+
+    Args:
+        scores (numpy structured array) scored pairs, as returned by score_blocks or read_scores
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+
+    Returns: (generator of (cluster_id, scores) tuples)
+    """
+    if config['linkage']:
+        return link_clusters(dedupe.clustering.greedyMatching(scores, config['threshold']))
+    if config['clustering'] == 'connected_components':
+        return connected_component_clusters(scores, config['threshold'],
+                                            config['max_hierarchical_size'],
+                                            config['clustering_workers'])
+    return hierarchical_clusters(scores, config['threshold'], config['clustering_workers'])
+
+
+def cluster_counts(scores, config, thresholds):
+    """Count the clusters formed at each of several thresholds
+
+    Args:
+        scores (numpy structured array) scored pairs, as returned by read_scores
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        thresholds (list of float) the clustering thresholds to try
+
+    Returns: (list of (threshold, number of clusters, number of clustered records) tuples)
+    """
+    counts = []
+    for threshold in thresholds:
+        n_clusters, n_records = 0, 0
+        for records, _ in cluster_scores(scores, dict(config, threshold=threshold)):
+            n_clusters += 1
+            n_records += len(records)
+        counts.append((threshold, n_clusters, n_records))
+    return counts
+
+
+def cluster(deduper, con, config, dbconfig=None, resume=False):
     """Run clustering on blocked data
 
+    If config['cluster_workers'] is greater than one, scoring is split by block_id range
+    across that many processes (see score_ranges) and the scores are clustered together.
+    This gives the same clusters as a serial run.
+
+    If config['persist_scores'] is set, the scored pairs are also written to the
+    scored_pairs table, so they can be clustered again at another threshold without
+    rescoring.
+
+    If config['checkpoint_ranges'] is set, the blocks are scored in that many block_id
+    ranges and the scored pairs of each range are committed to scored_pairs as soon as it
+    completes (see score_checkpointed). An interrupted run can then be continued by
+    passing resume.
+
+    The scores are clustered as described in cluster_scores. The clusters are produced
+    lazily, so they can be written out as they are found rather than held in a list as
+    dedupe.Dedupe.matchBlocks does.
+
     Args:
         deduper (dedupe.Dedupe or dedupe.StaticDedupe) A trained Dedupe object
         con (psycopg2.connection)
         config (dict) configuration options for a deduping run. Expected to have defaults applied
+        dbconfig (dict) database connection credentials, required for parallel scoring
+        resume (bool) continue a checkpointed run from its last committed block range
 
-    Returns: Cluster results from dedupe.Dedupe.matchBlocks.
-        Each record is in form: (cluster_id, scores)
+    Returns: (generator of (cluster_id, scores) tuples) in the format of dedupe's clustering
+
+    Raises: BlockingError if no pair of records was blocked together
     """
-    c4 = con.cursor('c4')
-    c4.execute("SELECT {all_columns}, block_id, smaller_ids FROM {schema}.smaller_coverage "
-               "INNER JOIN {schema}.entries_unique "
-               "USING (_unique_id) "
-               "ORDER BY (block_id)".format(**config))
+    if config['checkpoint_ranges']:
+        scores = score_checkpointed(deduper, con, config, dbconfig, resume)
+        if len(scores) == 0:
+            raise BlockingError('No records have been blocked together')
+        return cluster_scores(scores, config)
+
+    if config['cluster_workers'] > 1:
+        # More ranges than workers, so that a range with a slow block does not hold up the rest
+        ranges = block_ranges(con, config, config['cluster_workers'] * 4)
+    else:
+        ranges = [None]
 
-    return deduper.matchBlocks(candidates_gen(c4), threshold=config['threshold'])
+    scores = [s for s in score_ranges(deduper, con, config, ranges, dbconfig) if s is not None]
+    if not scores:
+        raise BlockingError('No records have been blocked together')
+    scores = sort_scores(numpy.concatenate(scores))
+
+    if config['persist_scores']:
+        logging.info("writing {schema}.scored_pairs".format(**config))
+        write_scores(scores, con, config)
+    return cluster_scores(scores, config)
 
 
 # Writing out results
@@ -384,7 +1118,7 @@ def write_results(clustered_dupes, con, config):
     """Write clustering results to the entity_map table
 
     Args:
-        clustered_dupes (list of (cluster_id, scores) tuples)
+        clustered_dupes (iterable of (cluster_id, scores) tuples)
         con (psycopg2.connection)
         config (dict) configuration options for a deduping run. Expected to have defaults applied
     """
@@ -398,22 +1132,30 @@ def write_results(clustered_dupes, con, config):
               "(_unique_id INT, canon_id INT, "
               " cluster_score FLOAT, PRIMARY KEY(_unique_id))".format(**config))
 
-    csv_file = tempfile.NamedTemporaryFile(prefix='entity_map_', delete=False,
-                                           mode='w')
-    csv_writer = csv.writer(csv_file)
-
+    # Clusters are streamed into the table in batches of at most write_batch_size rows,
+    # so they never all have to be held in memory at once
+    def copy_batch(rows):
+        with tempfile.TemporaryFile(mode='w+t') as f:
+            csv.writer(f).writerows(rows)
+            f.seek(0)
+            c.copy_expert("COPY {schema}.entity_map FROM STDIN CSV".format(**config), f)
+
+    progress = Progress('writing entity_map', None, config, 'rows')
+    num_clusters = 0
+    rows = []
     for cluster, scores in clustered_dupes:
+        num_clusters += 1
         cluster_id = cluster[0]
         for donor_id, score in zip(cluster, scores):
-            csv_writer.writerow([donor_id, cluster_id, score])
-
-    csv_file.close()
-
-    f = open(csv_file.name, 'r')
-    c.copy_expert("COPY {schema}.entity_map FROM STDIN CSV".format(**config), f)
-    f.close()
-
-    os.remove(csv_file.name)
+            rows.append((donor_id, cluster_id, score))
+        if len(rows) >= config['write_batch_size']:
+            copy_batch(rows)
+            progress.update(len(rows))
+            rows = []
+    if rows:
+        copy_batch(rows)
+        progress.update(len(rows))
+    progress.report()
 
     con.commit()
 
@@ -422,16 +1164,21 @@ def write_results(clustered_dupes, con, config):
 
     # Print out the number of duplicates found
     print('# duplicate sets')
-    print(len(clustered_dupes))
+    print(num_clusters)
 
 
 # ## Payoff
-def apply_results(con, config):
+def apply_results(con, config, dbconfig=None):
     """Combine results from entity_map table with unclustered records to create a canonical lookup
 
+    When linking two tables, unique_map also has the _source of each key, and dedupe_id is
+    set on both tables, so that linked records share it.
+
     Args:
         con (psycopg2.connection)
         config (dict) configuration options for a deduping run. Expected to have defaults applied
+        dbconfig (dict) database connection credentials, required if config['apply_workers']
+            is more than one
     """
     c = con.cursor()
     # Dedupe only cares about matched records; it doesn't have a canonical id
@@ -445,9 +1192,6 @@ def apply_results(con, config):
               "FROM {schema}.entity_map "
               "RIGHT JOIN {schema}.entries_unique USING(_unique_id)".format(**config))
 
-    # Remove the dedupe_id column from entries if it already exists
-    c.execute("ALTER TABLE {table} DROP COLUMN IF EXISTS dedupe_id".format(**config))
-
     # Merge clusters based upon exact matches of a subset of fields. This can
     # be done on the unique table or on the actual entries table, but it's more
     # efficient to do it now.
@@ -455,9 +1199,10 @@ def apply_results(con, config):
     for cols in config['merge_exact']:
         if not all(c in available_fields for c in cols):
             continue
-        exact_matches.merge('{}.map'.format(config['schema']), 'canon_id',
-                            '{}.entries_unique'.format(config['schema']), '_unique_id',
-                            cols, config['schema'], con)
+        with instrument.measure('merge_exact ' + ', '.join(cols), con, config['schema']):
+            exact_matches.merge('{}.map'.format(config['schema']), 'canon_id',
+                                '{}.entries_unique'.format(config['schema']), '_unique_id',
+                                cols, config['schema'], con, config)
 
     # Add that integer id back to the unique_entries table
     c.execute("""ALTER TABLE {schema}.entries_unique
@@ -471,21 +1216,363 @@ def apply_results(con, config):
     # create a mapping between the unique entries and the original entries
     c.execute("DROP TABLE IF EXISTS {schema}.unique_map".format(**config))
     c.execute("CREATE TABLE {schema}.unique_map AS ( "
-              "SELECT dedupe_id, unnest(src_ids) as {key} "
-              "FROM {schema}.entries_unique)".format(**config))
+              "SELECT dedupe_id, {0}unnest(src_ids) as {key} "
+              "FROM {schema}.entries_unique)".format(
+                  '_source, ' if config['linkage'] else '', **config))
 
     # Grab the remainder of the exact merges:
     for cols in config['merge_exact']:
         if all(c in available_fields for c in cols):
             continue
-        exact_matches.merge('{}.unique_map'.format(config['schema']), 'dedupe_id',
-                            config['table'], config['key'],
-                            cols, config['schema'], con)
+        with instrument.measure('merge_exact ' + ', '.join(cols), con, config['schema']):
+            exact_matches.merge('{}.unique_map'.format(config['schema']), 'dedupe_id',
+                                config['table'], config['key'],
+                                cols, config['schema'], con, config)
     con.commit()
 
+    # Carry the ids of the previous run over to the clusters that continue them
+    if config['stable_ids']:
+        registry.assign_stable_ids(con, config)
+
+    if config['apply_mode'] == 'map_table':
+        index_unique_map(con, config)
+    elif config['apply_mode'] == 'swap':
+        index_unique_map(con, config)
+        swap_results(con, config)
+    elif config['apply_mode'] == 'diff':
+        index_unique_map(con, config)
+        apply_changes(con, config, dbconfig)
+    elif config['apply_mode'] == 'chunked':
+        index_unique_map(con, config)
+        apply_chunked(con, config, dbconfig)
+    elif config['linkage']:
+        for source, table in enumerate((config['left_table'], config['right_table'])):
+            c.execute("ALTER TABLE {} DROP COLUMN IF EXISTS dedupe_id".format(table))
+            c.execute("ALTER TABLE {} ADD COLUMN dedupe_id INTEGER".format(table))
+            c.execute("UPDATE {} u SET dedupe_id = m.dedupe_id "
+                      "FROM {schema}.unique_map m WHERE u.{key} = m.{key} "
+                      "AND m._source = %s".format(table, **config), (source,))
+    else:
+        # Remove the dedupe_id column from entries if it already exists
+        c.execute("ALTER TABLE {table} DROP COLUMN IF EXISTS dedupe_id".format(**config))
+        c.execute("ALTER TABLE {table} ADD COLUMN dedupe_id INTEGER".format(**config))
+        c.execute("UPDATE {table} u SET dedupe_id = m.dedupe_id "
+                  "FROM {schema}.unique_map m WHERE u.{key} = m.{key}".format(**config))
+
+    con.commit()
+    c.close()
+
+
+def index_unique_map(con, config):
+    """Index the unique_map table so it can be used as a key -> dedupe_id lookup
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+    """
+    c = con.cursor()
+    # Keys are only unique within a table when linking two tables
+    c.execute("CREATE UNIQUE INDEX unique_map_key_idx "
+              "ON {schema}.unique_map ({0}{key})".format(
+                  '_source, ' if config['linkage'] else '', **config))
+    c.execute("CREATE INDEX unique_map_dedupe_id_idx "
+              "ON {schema}.unique_map (dedupe_id)".format(**config))
+    c.execute("ANALYZE {schema}.unique_map".format(**config))
+    con.commit()
+    c.close()
+
+
+# The comment swap_results leaves on <table>_previous, so it only ever drops its own tables
+SWAPPED_COMMENT = 'replaced by a pgdedupe swap'
+
+
+def quote_name(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def dependent_views(c, table):
+    """The views that depend on a table, or an empty list if it does not exist"""
+    c.execute("SELECT DISTINCT r.ev_class::regclass::TEXT AS view "
+              "FROM pg_depend d INNER JOIN pg_rewrite r ON r.oid = d.objid "
+              "WHERE d.classid = 'pg_rewrite'::regclass AND d.refobjid = to_regclass(%s) "
+              "AND r.ev_class <> d.refobjid ORDER BY 1", (table,))
+    return [row['view'] for row in c.fetchall()]
+
+
+def table_indexes(c, table):
+    """The indexes of a table, with their definition after the index and table names"""
+    c.execute("SELECT i.indexrelid::regclass::TEXT AS index, n.relname AS name, "
+              "i.indisunique, i.indisprimary, "
+              "substring(pg_get_indexdef(i.indexrelid) FROM ' USING .*') AS definition "
+              "FROM pg_index i INNER JOIN pg_class n ON n.oid = i.indexrelid "
+              "WHERE i.indrelid = %s::regclass ORDER BY n.relname", (table,))
+    return c.fetchall()
+
+
+def swap_results(con, config):
+    """Publish dedupe_id by building a new copy of the source table and swapping it in
+
+    The copy is created with the same columns, defaults, constraints, indexes, foreign
+    keys, privileges and comments as the source table, plus the new dedupe_id, and renamed into
+    place in the same transaction. Its indexes are renamed to those of the source table.
+    The source table is locked in EXCLUSIVE mode for all of it, so it can still be read
+    but no write can slip in between the copy and the rename. The source table is never
+    updated in place; it is kept as <table>_previous, replacing the one from the last
+    swap. Serial sequences are handed over to the new table.
+
+    Raises: Exception if the source table has triggers, or views or foreign keys that
+        depend on it, as these would keep referring to <table>_previous. Also if a
+        <table>_previous that no swap created is in the way, or views depend on it.
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+    """
+    c = con.cursor()
+    name = config['table'].rsplit('.', 1)[-1]
+    new_table = config['table'] + '_dedupe_new'
+    previous_table = config['table'] + '_previous'
+
+    c.execute("LOCK TABLE {table} IN EXCLUSIVE MODE".format(**config))
+    views = dependent_views(c, config['table'])
+    if views:
+        raise Exception('cannot swap {} while views depend on it: {}'.format(
+            config['table'], ', '.join(views)))
+    c.execute("SELECT conrelid::regclass::TEXT AS referencing FROM pg_constraint "
+              "WHERE confrelid = %s::regclass AND contype = 'f' ORDER BY 1",
+              (config['table'],))
+    referencing = [row['referencing'] for row in c.fetchall()]
+    if referencing:
+        raise Exception('cannot swap {} while foreign keys of {} refer to it'.format(
+            config['table'], ', '.join(referencing)))
+    c.execute("SELECT tgname FROM pg_trigger WHERE tgrelid = %s::regclass "
+              "AND NOT tgisinternal ORDER BY 1", (config['table'],))
+    triggers = [row['tgname'] for row in c.fetchall()]
+    if triggers:
+        raise Exception('cannot swap {}, which has triggers: {}'.format(
+            config['table'], ', '.join(triggers)))
+    c.execute("SELECT obj_description(to_regclass(%s), 'pg_class') AS comment, "
+              "to_regclass(%s) IS NOT NULL AS present", (previous_table, previous_table))
+    previous = c.fetchone()
+    if previous['present'] and previous['comment'] != SWAPPED_COMMENT:
+        raise Exception('{} was not created by a swap; rename or drop it first'.format(
+            previous_table))
+    views = dependent_views(c, previous_table)
+    if views:
+        raise Exception('cannot replace {} while views depend on it: {}'.format(
+            previous_table, ', '.join(views)))
+
+    c.execute("SELECT attname, pg_get_serial_sequence(%s, attname) AS sequence "
+              "FROM pg_attribute WHERE attrelid = %s::regclass "
+              "AND attnum > 0 AND NOT attisdropped ORDER BY attnum",
+              (config['table'], config['table']))
+    attributes = [row for row in c.fetchall() if row['attname'] != 'dedupe_id']
+    columns = ['"{}"'.format(row['attname']) for row in attributes]
+
+    logging.info("creating %s", new_table)
+    c.execute("DROP TABLE IF EXISTS {}".format(new_table))
+    c.execute("CREATE TABLE {} (LIKE {table} INCLUDING ALL)".format(new_table, **config))
+    c.execute("ALTER TABLE {} DROP COLUMN IF EXISTS dedupe_id".format(new_table))
+    c.execute("ALTER TABLE {} ADD COLUMN dedupe_id INTEGER".format(new_table))
+    c.execute("INSERT INTO {new} ({columns}, dedupe_id) "
+              "SELECT {t_columns}, m.dedupe_id "
+              "FROM {table} t LEFT JOIN {schema}.unique_map m ON t.{key} = m.{key}".format(
+                  new=new_table, columns=', '.join(columns),
+                  t_columns=', '.join('t.' + col for col in columns), **config))
+    c.execute("ANALYZE {}".format(new_table))
+
+    # LIKE copies neither foreign keys, privileges nor the comment on the table itself
+    c.execute("SELECT conname, pg_get_constraintdef(oid) AS definition FROM pg_constraint "
+              "WHERE conrelid = %s::regclass AND contype = 'f' ORDER BY conname",
+              (config['table'],))
+    for row in c.fetchall():
+        c.execute("ALTER TABLE {} ADD CONSTRAINT {} {}".format(
+            new_table, quote_name(row['conname']), row['definition']))
+    c.execute("SELECT a.privilege_type, a.is_grantable, "
+              "CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(r.rolname) END "
+              "AS grantee "
+              "FROM pg_class t, aclexplode(t.relacl) a "
+              "LEFT JOIN pg_roles r ON r.oid = a.grantee "
+              "WHERE t.oid = %s::regclass", (config['table'],))
+    for row in c.fetchall():
+        c.execute("GRANT {} ON {} TO {}{}".format(
+            row['privilege_type'], new_table, row['grantee'],
+            ' WITH GRANT OPTION' if row['is_grantable'] else ''))
+    c.execute("SELECT obj_description(%s::regclass, 'pg_class') AS comment",
+              (config['table'],))
+    comment = c.fetchone()['comment']
+    if comment is not None:
+        c.execute("COMMENT ON TABLE {} IS %s".format(new_table), (comment,))
+
+    # Pair the copied indexes with those of the source table to give them their names
+    new_indexes = table_indexes(c, new_table)
+    renames = []
+    for old in table_indexes(c, config['table']):
+        for new in new_indexes:
+            if (new['indisunique'], new['indisprimary'], new['definition']) == \
+                    (old['indisunique'], old['indisprimary'], old['definition']):
+                new_indexes.remove(new)
+                renames.append((old, new))
+                break
+
+    logging.info("swapping %s into place", new_table)
+    for row in attributes:
+        if row['sequence']:
+            c.execute('ALTER SEQUENCE {} OWNED BY {}."{}"'.format(
+                row['sequence'], new_table, row['attname']))
+    c.execute("DROP TABLE IF EXISTS {}".format(previous_table))
+    for old, new in renames:
+        c.execute("ALTER INDEX {} RENAME TO {}".format(
+            old['index'], quote_name(old['name'][:63 - len('_previous')] + '_previous')))
+    c.execute("ALTER TABLE {table} RENAME TO {}".format(name + '_previous', **config))
+    c.execute("COMMENT ON TABLE {} IS %s".format(previous_table), (SWAPPED_COMMENT,))
+    for old, new in renames:
+        c.execute("ALTER INDEX {} RENAME TO {}".format(new['index'], quote_name(old['name'])))
+    c.execute("ALTER TABLE {} RENAME TO {}".format(new_table, name))
+    con.commit()
+    c.close()
+
+
+def update_in_chunks(con, config, statement, chunks, dbconfig=None):
+    """Run an UPDATE once per chunk of rows, committing after each chunk
+
+    With config['apply_workers'] above one, the chunks are shared out among that many
+    threads, each with its own connection, so they run at the same time.
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        statement (str) the UPDATE, with %(lo)s and %(hi)s placeholders for the chunk bounds
+        chunks (list of (lo, hi) tuples) the bounds of each chunk
+        dbconfig (dict) database connection credentials, required for more than one worker
+
+    Returns: (int) the number of updated rows
+    """
+    remaining = list(reversed(chunks))
+    lock = threading.Lock()
+    progress = {'chunks': 0, 'rows': 0}
+    errors = []
+
+    def work(con):
+        c = con.cursor()
+        while not errors:
+            with lock:
+                if not remaining:
+                    break
+                lo, hi = remaining.pop()
+            c.execute(statement, {'lo': lo, 'hi': hi})
+            con.commit()
+            with lock:
+                progress['chunks'] += 1
+                progress['rows'] += c.rowcount
+                logging.info("updated %s of %s chunks (%s rows)",
+                             progress['chunks'], len(chunks), progress['rows'])
+        c.close()
+
+    def run_worker():
+        worker_con = psycopg2.connect(cursor_factory=statement_cursor(config), **dbconfig)
+        try:
+            apply_settings(worker_con, config, 'apply_results')
+            work(worker_con)
+        except Exception as e:
+            errors.append(e)
+            worker_con.rollback()
+        finally:
+            worker_con.close()
+
+    if config['apply_workers'] > 1:
+        if dbconfig is None:
+            raise Exception('apply_workers requires the database credentials')
+        threads = [threading.Thread(target=run_worker) for _ in range(config['apply_workers'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+    else:
+        work(con)
+    return progress['rows']
+
+
+def apply_chunked(con, config, dbconfig=None):
+    """Set dedupe_id on the source table in key ranges, committing after each range
+
+    The key ranges hold config['apply_batch_size'] rows of unique_map each, and are
+    updated by config['apply_workers'] connections at once (see update_in_chunks). This
+    avoids one huge transaction holding locks on the source table.
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        dbconfig (dict) database connection credentials, required for more than one worker
+    """
+    c = con.cursor()
+    c.execute("ALTER TABLE {table} DROP COLUMN IF EXISTS dedupe_id".format(**config))
     c.execute("ALTER TABLE {table} ADD COLUMN dedupe_id INTEGER".format(**config))
-    c.execute("UPDATE {table} u SET dedupe_id = m.dedupe_id "
-              "FROM {schema}.unique_map m WHERE u.{key} = m.{key}".format(**config))
+    c.execute("SELECT {key} AS lo FROM ("
+              " SELECT {key}, row_number() OVER (ORDER BY {key}) AS rn "
+              " FROM {schema}.unique_map) s "
+              "WHERE (rn - 1) %% %s = 0 ORDER BY lo".format(**config),
+              (config['apply_batch_size'],))
+    bounds = [row['lo'] for row in c.fetchall()]
+    con.commit()
+    c.close()
+
+    # Unmapped rows keep the NULL dedupe_id of the new column
+    updated = update_in_chunks(
+        con, config,
+        "UPDATE {table} u SET dedupe_id = m.dedupe_id "
+        "FROM {schema}.unique_map m WHERE u.{key} = m.{key} "
+        "AND m.{key} >= %(lo)s AND (%(hi)s IS NULL OR m.{key} < %(hi)s)".format(**config),
+        list(zip(bounds, bounds[1:] + [None])), dbconfig)
+    logging.info("set dedupe_id on %s rows", updated)
+
 
+def apply_changes(con, config, dbconfig=None):
+    """Update dedupe_id only on the rows of the source table where it changed
+
+    The rows whose current dedupe_id differs from unique_map (including rows that are no
+    longer mapped) are collected into the dedupe_id_changes table, and then updated in
+    batches of config['apply_batch_size'] rows with a commit after each batch (see
+    update_in_chunks).
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        dbconfig (dict) database connection credentials, required for more than one worker
+
+    Returns: (int) the number of rows whose dedupe_id changed
+    """
+    c = con.cursor()
+    c.execute("SELECT 1 FROM pg_attribute WHERE attrelid = %s::regclass "
+              "AND attname = 'dedupe_id' AND NOT attisdropped", (config['table'],))
+    if c.fetchone() is None:
+        c.execute("ALTER TABLE {table} ADD COLUMN dedupe_id INTEGER".format(**config))
+
+    logging.info("finding changed dedupe_ids")
+    c.execute("DROP TABLE IF EXISTS {schema}.dedupe_id_changes".format(**config))
+    c.execute("CREATE TABLE {schema}.dedupe_id_changes AS ("
+              "SELECT row_number() OVER () AS change_id, t.{key}, m.dedupe_id "
+              "FROM {table} t LEFT JOIN {schema}.unique_map m ON t.{key} = m.{key} "
+              "WHERE t.dedupe_id IS DISTINCT FROM m.dedupe_id)".format(**config))
+    c.execute("CREATE UNIQUE INDEX dedupe_id_changes_idx "
+              "ON {schema}.dedupe_id_changes (change_id)".format(**config))
+    c.execute("SELECT count(*) AS n FROM {schema}.dedupe_id_changes".format(**config))
+    num_changes = c.fetchone()['n']
     con.commit()
     c.close()
+
+    batch_size = config['apply_batch_size']
+    update_in_chunks(
+        con, config,
+        "UPDATE {table} t SET dedupe_id = ch.dedupe_id "
+        "FROM {schema}.dedupe_id_changes ch "
+        "WHERE t.{key} = ch.{key} "
+        "AND ch.change_id BETWEEN %(lo)s AND %(hi)s".format(**config),
+        [(lo, lo + batch_size - 1) for lo in range(1, num_changes + 1, batch_size)],
+        dbconfig)
+
+    print('# rows with a changed dedupe_id')
+    print(num_changes)
+    return num_changes
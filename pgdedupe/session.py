@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tune the Postgres session for each stage of a run.
+
+The settings only apply to pgdedupe's own connection, for the duration of a stage, so
+no server-wide changes are needed on a shared database. They are set with a session-level
+SET and RESET afterwards, rather than SET LOCAL, because the stages commit several times.
+The worker connections a stage opens get the same settings.
+"""
+import logging
+import contextlib
+
+import psycopg2.extensions
+
+PROFILES = {
+    'high_throughput': {
+        # The GROUP BY over the source table and the primary key build
+        'preprocess': {'work_mem': '512MB',
+                       'maintenance_work_mem': '1GB',
+                       'max_parallel_maintenance_workers': 4,
+                       'synchronous_commit': 'off'},
+        # The array_agg of covered_blocks, the COPY of blocking_map and its indexes
+        'create_blocking': {'work_mem': '512MB',
+                            'maintenance_work_mem': '1GB',
+                            'max_parallel_maintenance_workers': 4,
+                            'synchronous_commit': 'off'},
+        # The COPY of scored_pairs
+        'cluster': {'synchronous_commit': 'off'},
+        # The COPY of entity_map and its index
+        'write_results': {'maintenance_work_mem': '1GB',
+                          'synchronous_commit': 'off'},
+        # The joins and updates of the source table and the exact-match merges
+        'apply_results': {'work_mem': '256MB',
+                          'maintenance_work_mem': '1GB',
+                          'max_parallel_maintenance_workers': 4,
+                          'synchronous_commit': 'off'},
+    },
+}
+
+
+def stage_settings(config, stage):
+    """The settings for a stage: those of config['session_profile'], overridden by those
+    given for the stage in config['session_settings']
+
+    Returns: (dict) setting name -> value
+    """
+    settings = {}
+    if config['session_profile']:
+        settings.update(PROFILES[config['session_profile']].get(stage, {}))
+    settings.update(config['session_settings'].get(stage, {}))
+    return settings
+
+
+def setting_value(value):
+    """Format a setting's value for set_config; YAML reads on and off as booleans"""
+    if isinstance(value, bool):
+        return 'on' if value else 'off'
+    return str(value)
+
+
+def settable(con, names):
+    """The settings in names that exist on this server and that a user may set"""
+    c = con.cursor()
+    c.execute("SELECT name FROM pg_settings WHERE name = ANY(%s) AND context = 'user'",
+              (list(names),))
+    found = set(row['name'] for row in c.fetchall())
+    c.close()
+    return found
+
+
+def apply_settings(con, config, stage):
+    """Set a stage's session settings on a connection
+
+    Settings this server does not know or does not let users change are skipped with
+    a warning, so that a profile also works on older Postgres versions. Worker
+    connections call this once after connecting, since settings are per session.
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        stage (str) the name of the stage
+
+    Returns: (list of str) the names of the settings that were set
+    """
+    settings = stage_settings(config, stage)
+    if not settings:
+        return []
+    names = sorted(settable(con, settings))
+    for name in sorted(set(settings) - set(names)):
+        logging.warning('skipping setting %s, which cannot be set on this server', name)
+    c = con.cursor()
+    for name in names:
+        c.execute("SELECT set_config(%s, %s, false)", (name, setting_value(settings[name])))
+        logging.info('%s: set %s to %s', stage, name, settings[name])
+    con.commit()
+    c.close()
+    return names
+
+
+@contextlib.contextmanager
+def tuned(con, config, stage):
+    """Apply a stage's session settings while it runs, and reset them afterwards even if
+    the stage fails
+
+    Args:
+        con (psycopg2.connection)
+        config (dict) configuration options for a deduping run. Expected to have defaults applied
+        stage (str) the name of the stage
+    """
+    names = apply_settings(con, config, stage)
+    try:
+        yield
+    finally:
+        if names and not con.closed:
+            # RESET cannot run in a transaction that a failed statement aborted
+            if con.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                con.rollback()
+            c = con.cursor()
+            for name in names:
+                c.execute("RESET {}".format(name))
+            con.commit()
+            c.close()
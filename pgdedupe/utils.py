@@ -2,9 +2,15 @@ import datetime
 import hashlib
 import json
 import logging
+import threading
 import yaml
 import os
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 
 def load_config(filename):
     ext = os.path.splitext(filename)[1].lower()
@@ -42,3 +48,51 @@ def create_model_definition(config, deduper):
     }
     logging.debug('Model definition = %s', model_definition)
     return model_definition
+
+
+def prefetch(iterable, depth):
+    """Iterate over an iterable on a background thread, keeping up to `depth` items ready
+
+    Useful when producing items is I/O-bound, like reading from a database cursor, while
+    consuming them is CPU-bound. Exceptions raised while producing are re-raised to the
+    consumer.
+
+    Args:
+        iterable (iterable) the items to produce
+        depth (int) the maximum number of produced items waiting to be consumed
+
+    Yields: the items of iterable, in order
+    """
+    items = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+                if stopped.is_set():
+                    return
+            items.put((done, None))
+        except Exception as e:
+            items.put((done, e))
+
+    thread = threading.Thread(target=produce, name='prefetch')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # If the consumer stops early, unblock the producer so it can see it has to stop
+        stopped.set()
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
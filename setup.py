@@ -38,11 +38,16 @@ setup(
                  'pgdedupe'},
     entry_points={
         'console_scripts': [
-            'pgdedupe=pgdedupe.cli:main'
+            'pgdedupe=pgdedupe.cli:main',
+            'pgdedupe-recluster=pgdedupe.cli:recluster',
+            'pgdedupe-files=pgdedupe.cli:files'
         ]
     },
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'parquet': ['pandas>=0.21', 'pyarrow'],
+    },
     license="MIT license",
     zip_safe=False,
     keywords='pgdedupe',
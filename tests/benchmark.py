@@ -0,0 +1,141 @@
+# Benchmark the pipeline on fake datasets of increasing size
+#
+#   python -m tests.benchmark --scale 10000 --scale 100000 --output results.json
+#   python -m tests.benchmark --baseline results.json --output new.json
+#
+# For every scale, the full pipeline is run once, and then every stage is run again on
+# its own in a fresh process, so that each stage's peak memory is measured by itself.
+import os
+import sys
+import json
+import tempfile
+import subprocess
+
+import click
+import yaml
+import psycopg2 as psy
+import testing.postgresql
+
+import tests.generate_fake_dataset as gen
+import tests.initialize_db as initdb
+from pgdedupe.pipeline import STAGES
+
+# Rows per person in create_csv, on average
+ROWS_PER_PERSON = 20
+
+
+def run_pgdedupe(config_file, db_file, args=()):
+    """Run the pgdedupe command in a new process and return its run report"""
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+    env = dict(os.environ, PYTHONHASHSEED='123')
+    subprocess.check_call([sys.executable, '-m', 'pgdedupe.cli',
+                           '--config', config_file, '--db', db_file] + list(args), env=env)
+    with open(config['run_report']) as f:
+        return json.load(f)
+
+
+def stage_results(report):
+    return dict((stage['stage'], {'wall_seconds': stage['wall_seconds'],
+                                  'cpu_seconds': stage['cpu_seconds'],
+                                  'max_rss_kb': stage['max_rss_kb']})
+                for stage in report['stages'] if stage['stage'] in STAGES)
+
+
+def benchmark(scale, workdir, config):
+    """Benchmark the pipeline on a fake dataset of about scale records
+
+    Returns: (dict) the number of records, the stage results of the full run ('full')
+        and those of each stage run on its own ('stages')
+    """
+    psql = testing.postgresql.Postgresql()
+    try:
+        db_file = os.path.join(workdir, 'db.yaml')
+        with open(db_file, 'w') as f:
+            yaml.dump(psql.dsn(), f)
+        csv_file = os.path.join(workdir, 'people.csv')
+        gen.create_csv_vectorized(max(scale // ROWS_PER_PERSON, 1), csv_file, seed=0)
+        initdb.init(db_file, csv_file)
+
+        con = psy.connect(**psql.dsn())
+        c = con.cursor()
+        c.execute("SELECT count(*) FROM {table}".format(**config))
+        records = c.fetchone()[0]
+        con.close()
+
+        config_file = os.path.join(workdir, 'config.yaml')
+        config = dict(config, run_report=os.path.join(workdir, 'report.json'),
+                      settings_file=os.path.join(workdir, 'settings'),
+                      # So that clustering and writing the results can also run separately
+                      persist_scores=True)
+        with open(config_file, 'w') as f:
+            yaml.dump(config, f)
+
+        result = {'records': records,
+                  'full': stage_results(run_pgdedupe(config_file, db_file)),
+                  'stages': {}}
+        for stage in STAGES:
+            report = run_pgdedupe(config_file, db_file,
+                                  ['--from-stage', stage, '--to-stage', stage])
+            result['stages'].update(stage_results(report))
+        return result
+    finally:
+        psql.stop()
+
+
+def regressions(results, baseline, tolerance):
+    """Compare benchmark results to a baseline
+
+    Returns: (list of str) a description of every stage that took more than
+        (1 + tolerance) times as long, or as much memory, as in the baseline
+    """
+    found = []
+    for scale, result in sorted(results.items()):
+        if scale not in baseline:
+            continue
+        for run in ('full', 'stages'):
+            for stage, measured in sorted(result[run].items()):
+                expected = baseline[scale][run].get(stage)
+                if expected is None:
+                    continue
+                for measure in ('wall_seconds', 'max_rss_kb'):
+                    limit = expected[measure] * (1 + tolerance) if expected[measure] else None
+                    if limit is not None and measured[measure] > limit:
+                        found.append('{} records, {} {}: {} {:.4g} -> {:.4g}'.format(
+                            scale, run, stage, measure, expected[measure], measured[measure]))
+    return found
+
+
+@click.command()
+@click.option('--config', help='pgdedupe configuration to benchmark.', default='config.yaml')
+@click.option('--scale', type=int, multiple=True,
+              help='Approximate number of records. Give several to benchmark each.')
+@click.option('--output', help='File to write the results to as JSON.',
+              default='benchmark.json')
+@click.option('--baseline', help='Results of an earlier benchmark to compare to.')
+@click.option('--tolerance', type=float, default=0.2,
+              help='Report a regression when a stage takes this fraction more time or memory '
+                   'than in the baseline.')
+def main(config, scale, output, baseline, tolerance):
+    with open(config) as f:
+        config = yaml.safe_load(f)
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='pgdedupe_benchmark_')
+    for n in scale or (10000, 100000, 1000000):
+        print('benchmarking', n, 'records')
+        results[str(n)] = benchmark(n, workdir, config)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('wrote results to', output)
+
+    if baseline:
+        with open(baseline) as f:
+            found = regressions(results, json.load(f), tolerance)
+        for regression in found:
+            print('regression:', regression)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
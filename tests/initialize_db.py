@@ -3,14 +3,50 @@ import yaml
 import os
 from os import path, system
 
+import psycopg2
+
 
 @click.command()
 @click.option('--db', help='YAML-formatted database connection credentials.', required=True)
 @click.option('--csv', help='CSV file to load into the database table', required=True)
-def main(db, csv):
-    init(db, csv)
+@click.option('--psql', is_flag=True, help='Load the file with the psql command line client')
+def main(db, csv, psql):
+    if psql:
+        init_psql(db, csv)
+    else:
+        init(db, csv)
 
 def init(db, csv):
+    """Load the CSV into dedupe.entries with COPY over a single connection"""
+    with open(db) as f:
+        con = psycopg2.connect(**yaml.load(f))
+    c = con.cursor()
+    c.execute("CREATE SCHEMA IF NOT EXISTS dedupe")
+    c.execute("DROP TABLE IF EXISTS dedupe.entries")
+    c.execute("""
+         CREATE TABLE dedupe.entries (
+             uuid UUID,
+             first_name VARCHAR,
+             last_name VARCHAR,
+             ssn VARCHAR(11),
+             sex VARCHAR(1),
+             dob VARCHAR(10),
+             race VARCHAR,
+             ethnicity VARCHAR,
+             entry_id SERIAL,
+             full_name VARCHAR
+         )""")
+    with open(csv) as f:
+        c.copy_expert("COPY dedupe.entries (uuid, first_name, last_name, ssn, sex, dob, race, "
+                      "ethnicity) FROM STDIN WITH CSV HEADER", f)
+    c.execute("UPDATE dedupe.entries SET full_name = first_name || ' ' || last_name")
+    # Only index once the rows are loaded
+    c.execute("ALTER TABLE dedupe.entries ADD PRIMARY KEY (entry_id)")
+    con.commit()
+    con.close()
+
+
+def init_psql(db, csv):
     # We'll shell out to `psql`, so set the environment variables for it:
     with open(db) as f:
         for k,v in yaml.load(f).items():
@@ -0,0 +1,28 @@
+import numpy
+
+from pgdedupe.components import component_labels, split_components, component_cluster
+
+
+def scored_pairs(pairs):
+    scores = numpy.empty(len(pairs), dtype=[('pairs', 'i8', 2), ('score', 'f4')])
+    for i, (a, b, score) in enumerate(pairs):
+        scores[i] = ((a, b), score)
+    return scores
+
+
+def test_component_labels():
+    labels = component_labels([(5, 3), (3, 9), (1, 2), (7, 7)])
+    assert labels == {1: 1, 2: 1, 3: 3, 5: 3, 9: 3, 7: 7}
+
+
+def test_split_components():
+    scores = scored_pairs([(4, 5, .9), (1, 2, .8), (2, 3, .7), (6, 5, .6)])
+    parts = split_components(scores)
+    assert [sorted(numpy.unique(p['pairs'])) for p in parts] == [[1, 2, 3], [4, 5, 6]]
+    assert split_components(scores[:0]) == []
+
+
+def test_component_cluster():
+    ids, scores = component_cluster(scored_pairs([(2, 1, .5), (2, 3, .75)]))
+    assert ids == (1, 2, 3)
+    assert scores == (.5, .75, .75)
@@ -0,0 +1,15 @@
+from pgdedupe.diagnostics import plan_rows, CREATE_TABLE_AS, COPY_FROM
+
+
+def test_plan_rows_of_modifying_statement():
+    plan = [{'Plan': {'Node Type': 'ModifyTable', 'Actual Rows': 0, 'Actual Loops': 1,
+                      'Plans': [{'Node Type': 'Hash Join', 'Actual Rows': 42,
+                                 'Actual Loops': 1}]}}]
+    assert plan_rows(plan) == 42
+
+
+def test_bulk_loaded_tables_are_found():
+    match = CREATE_TABLE_AS.match("CREATE TABLE dedupe.entries_unique AS (\n SELECT 1)")
+    assert match.group(2) == 'dedupe.entries_unique'
+    assert COPY_FROM.match("COPY dedupe.entity_map FROM STDIN CSV").group(1) == 'dedupe.entity_map'
+    assert COPY_FROM.match("COPY (SELECT 1) TO STDOUT CSV") is None
@@ -0,0 +1,52 @@
+import numpy
+import pandas as pd
+
+from pgdedupe.files import preprocess, create_blocking, candidates, merge_exact
+from pgdedupe.run import process_options
+
+
+class LastNameBlocker(object):
+    """Blocks records by last name and by first initial"""
+    index_fields = []
+
+    def __call__(self, records):
+        for unique_id, record in records:
+            yield 'last:' + record['last_name'], unique_id
+            yield 'first:' + (record['first_name'] or '')[:1], unique_id
+
+
+def files_config(tmpdir):
+    rows = pd.DataFrame({'id': ['1', '2', '3', '4', '5', '6'],
+                         'first_name': ['ann', 'ann', 'bob', 'bo', None, 'cy'],
+                         'last_name': ['x', 'x', 'y', 'y', 'z', 'w'],
+                         'ssn': ['1', '1', '2', '2', None, None]})
+    rows.to_csv(str(tmpdir.join('people.csv')), index=False)
+    return process_options({'schema': 'dedupe',
+                            'key': 'id',
+                            'input_file': str(tmpdir.join('people.csv')),
+                            'fields': [{'field': 'first_name', 'type': 'String'},
+                                       {'field': 'last_name', 'type': 'String'}],
+                            'merge_exact': [['ssn']]})
+
+
+def test_preprocess_merges_exact_duplicates(tmpdir):
+    rows, unique_ids, records = preprocess(files_config(tmpdir))
+    assert list(unique_ids) == [0, 0, 1, 2, 3, 4]
+    assert [record['first_name'] for record in records] == ['ann', 'bob', 'bo', None, 'cy']
+
+
+def test_candidates_skip_pairs_of_smaller_blocks(tmpdir):
+    config = files_config(tmpdir)
+    rows, unique_ids, records = preprocess(config)
+    deduper = type('Deduper', (object,), {'blocker': LastNameBlocker()})()
+    blocks = create_blocking(deduper, records, config, str(tmpdir))
+    # bob and bo share both of their blocks; only the first compares them
+    assert [[(i, set(smaller)) for i, _, smaller in block]
+            for block in candidates(blocks, records)] == [[(1, set()), (2, set())],
+                                                          [(1, {0}), (2, {0})]]
+
+
+def test_merge_exact(tmpdir):
+    rows, unique_ids, records = preprocess(files_config(tmpdir))
+    merged = merge_exact(rows, numpy.array([0, 0, 1, 2, 3, 4]), ['ssn'])
+    assert list(merged) == [0, 0, 1, 1, 3, 4]
@@ -0,0 +1,40 @@
+import json
+
+from pgdedupe import instrument
+
+
+def test_measure_without_report_does_nothing():
+    # No report has been started, so the connection is never used
+    with instrument.measure('stage', None, 'dedupe'):
+        pass
+
+
+def test_report_is_written_with_tags(tmpdir):
+    filename = str(tmpdir.join('report.json'))
+    report = instrument.start_report({'schema': 'dedupe'})
+    instrument.tag(model_hash='abc')
+    instrument.finish_report(report, filename)
+    with open(filename) as f:
+        written = json.load(f)
+    assert written['model_hash'] == 'abc'
+    assert written['schema'] == 'dedupe'
+    assert written['stages'] == []
+    # Tags only go to reports that are being collected
+    instrument.tag(model_hash='def')
+    assert report.tags['model_hash'] == 'abc'
+
+
+def test_counted_without_report_passes_iterable_through():
+    items = [1, 2, 3]
+    assert instrument.counted(items, 'items') is items
+
+
+def test_worker_counters_are_merged_into_the_step():
+    report = instrument.start_report({'schema': 'dedupe'})
+    with instrument.measure('cluster', None, 'dedupe'):
+        with instrument.worker_counters() as counters:
+            list(instrument.counted(iter([1, 2]), 'blocks'))
+        instrument.merge_counters(counters)
+        instrument.merge_counters({'blocks': 3})
+    instrument.finish_report(report)
+    assert report.stages[0]['counters'] == {'blocks': 5}
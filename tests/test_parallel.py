@@ -0,0 +1,65 @@
+import tests.generate_fake_dataset as gen
+import tests.initialize_db as initdb
+import yaml
+import testing.postgresql
+import psycopg2
+import psycopg2.extras
+
+from mock import patch
+from pgdedupe.utils import load_config
+from pgdedupe.run import process_options, preprocess, create_blocking, cluster, train
+
+
+def test_parallel_scoring_matches_serial(tmpdir):
+    """Test that scoring in worker processes comes up with the same clusters as
+    scoring serially, with the same seed"""
+
+    psql = testing.postgresql.Postgresql()
+    try:
+        db_file = str(tmpdir.join('db.yaml'))
+        with open(db_file, 'w') as f:
+            yaml.dump(psql.dsn(), f)
+
+        csv_file = str(tmpdir.join('pop.csv'))
+        gen.create_csv(gen.create_population(100), csv_file)
+        initdb.init(db_file, csv_file)
+
+        dbconfig = load_config(db_file)
+        config = process_options({
+            'schema': 'dedupe',
+            'table': 'dedupe.entries',
+            'key': 'entry_id',
+            'fields': [
+                {'field': 'ssn', 'type': 'String', 'has_missing': True},
+                {'field': 'first_name', 'type': 'String'},
+                {'field': 'last_name', 'type': 'String'},
+                {'field': 'dob', 'type': 'String'},
+                {'field': 'sex', 'type': 'Categorical', 'categories': ['M', 'F']},
+            ],
+            'interactions': [['last_name', 'dob'], ['ssn', 'dob']],
+            'filter_condition': ('last_name is not null AND '
+                                 '(ssn is not null OR (first_name is not null AND '
+                                 'dob is not null))'),
+            'recall': 0.99,
+            'prompt_for_labels': False,
+            'seed': 0,
+            'training_file': 'tests/dedup_postgres_training.json',
+            # The workers read the saved model
+            'settings_file': str(tmpdir.join('settings')),
+        })
+        con = psycopg2.connect(cursor_factory=psycopg2.extras.RealDictCursor, **dbconfig)
+        preprocess(con, config)
+        with patch.dict('os.environ', {'PYTHONHASHSEED': '123'}):
+            deduper = train(con, config)
+        create_blocking(deduper, con, config)
+
+        serial = cluster(deduper, con, dict(config, cluster_workers=1), dbconfig)
+        serial = [sorted(records) for records, scores in serial]
+        parallel = cluster(deduper, con, dict(config, cluster_workers=2), dbconfig)
+        parallel = [sorted(records) for records, scores in parallel]
+        con.close()
+
+        assert serial
+        assert sorted(parallel) == sorted(serial)
+    finally:
+        psql.stop()
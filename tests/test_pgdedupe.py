@@ -39,3 +39,10 @@ def test_command_line_interface():
     assert help_result.exit_code == 0
     assert '--help' in help_result.output
     assert 'Show this message and exit' in help_result.output
+
+
+def test_recluster_command_line_interface():
+    runner = CliRunner()
+    help_result = runner.invoke(cli.recluster, ['--help'])
+    assert help_result.exit_code == 0
+    assert '--threshold' in help_result.output
@@ -0,0 +1,13 @@
+from pgdedupe.pipeline import stage_hash
+
+
+def test_partitioned_cluster_depends_on_threshold():
+    config = {'table': 'people', 'left_table': None, 'right_table': None, 'key': 'id',
+              'fields': [], 'filter_condition': '1=1', 'partition_by': None,
+              'interactions': [], 'classifier': None, 'hyperparameters': None,
+              'recall': 0.9, 'seed': 0, 'threshold': 0.5, 'clustering': 'hierarchical',
+              'max_hierarchical_size': None, 'settings_file': '/nonexistent'}
+    changed = dict(config, threshold=0.7)
+    assert stage_hash('cluster', config) == stage_hash('cluster', changed)
+    config['partition_by'] = changed['partition_by'] = 'state'
+    assert stage_hash('cluster', config) != stage_hash('cluster', changed)
@@ -0,0 +1,22 @@
+import json
+
+from pgdedupe.progress import Progress
+
+
+def test_track_counts_items_and_writes_progress_file(tmpdir):
+    filename = str(tmpdir.join('progress.json'))
+    config = {'progress_interval': 60, 'progress_file': filename}
+    progress = Progress('scoring blocks', 10, config, 'blocks')
+    assert list(progress.track([[1, 2], [3]], size=len)) == [[1, 2], [3]]
+    with open(filename) as f:
+        status = json.load(f)
+    assert status['step'] == 'scoring blocks'
+    assert status['done'] == 3
+    assert status['total'] == 10
+
+
+def test_no_eta_without_total():
+    config = {'progress_interval': 60, 'progress_file': None}
+    progress = Progress('writing entity_map', None, config)
+    progress.update(5)
+    assert progress.status()['eta_seconds'] is None
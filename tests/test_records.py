@@ -0,0 +1,41 @@
+import pickle
+
+from pgdedupe.records import Record, record_type, compact_rows
+
+
+class FakeCursor(object):
+    """Mimics a psycopg2 cursor that only has a description once iterated"""
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+        self.description = None
+
+    def __iter__(self):
+        self.description = [(c,) for c in self.columns]
+        return iter(self.rows)
+
+
+def test_record_lookup():
+    Person = record_type(['_unique_id', 'first_name'])
+    r = Person((1, 'Ann'))
+    assert isinstance(r, Record)
+    assert r['first_name'] == 'Ann'
+    assert r[0] == 1
+    assert 'first_name' in r
+    assert r.get('ssn') is None
+    assert r.items() == [('_unique_id', 1), ('first_name', 'Ann')]
+    assert record_type(('_unique_id', 'first_name')) is Person
+
+
+def test_record_pickle():
+    r = record_type(['_unique_id', 'dob'])((3, '1990-01-01'))
+    r2 = pickle.loads(pickle.dumps(r))
+    assert r2 == r
+    assert r2['dob'] == '1990-01-01'
+
+
+def test_compact_rows():
+    cur = FakeCursor(['_unique_id', 'last_name'], [(1, 'Smith'), (2, 'Jones')])
+    rows = list(compact_rows(cur))
+    assert [r['last_name'] for r in rows] == ['Smith', 'Jones']
+    assert list(compact_rows(FakeCursor(['a'], []))) == []
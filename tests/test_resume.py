@@ -0,0 +1,65 @@
+import tests.generate_fake_dataset as gen
+import tests.initialize_db as initdb
+import yaml
+import pytest
+import testing.postgresql
+import psycopg2
+import psycopg2.extras
+
+from mock import patch
+from pgdedupe.utils import load_config
+from pgdedupe.run import process_options
+from pgdedupe.pipeline import STAGES, run_pipeline, completed_stages
+
+
+def test_resume_after_apply_results_failure(tmpdir):
+    """Test that a run whose apply_results failed resumes there, without clustering
+    again, even though its scores were not saved"""
+
+    psql = testing.postgresql.Postgresql()
+    try:
+        db_file = str(tmpdir.join('db.yaml'))
+        with open(db_file, 'w') as f:
+            yaml.dump(psql.dsn(), f)
+
+        csv_file = str(tmpdir.join('pop.csv'))
+        gen.create_csv(gen.create_population(100), csv_file)
+        initdb.init(db_file, csv_file)
+
+        dbconfig = load_config(db_file)
+        config = process_options({
+            'schema': 'dedupe',
+            'table': 'dedupe.entries',
+            'key': 'entry_id',
+            'fields': [
+                {'field': 'ssn', 'type': 'String', 'has_missing': True},
+                {'field': 'first_name', 'type': 'String'},
+                {'field': 'last_name', 'type': 'String'},
+                {'field': 'dob', 'type': 'String'},
+                {'field': 'sex', 'type': 'Categorical', 'categories': ['M', 'F']},
+            ],
+            'interactions': [['last_name', 'dob'], ['ssn', 'dob']],
+            'filter_condition': ('last_name is not null AND '
+                                 '(ssn is not null OR (first_name is not null AND '
+                                 'dob is not null))'),
+            'recall': 0.99,
+            'prompt_for_labels': False,
+            'seed': 0,
+            'training_file': 'tests/dedup_postgres_training.json',
+            'settings_file': str(tmpdir.join('settings')),
+        })
+        con = psycopg2.connect(cursor_factory=psycopg2.extras.RealDictCursor, **dbconfig)
+
+        with patch('pgdedupe.pipeline.apply_results', side_effect=Exception('apply failed')):
+            with pytest.raises(Exception):
+                run_pipeline(con, config, dbconfig)
+        con.rollback()
+        assert completed_stages(con, config) == list(STAGES[:-1])
+
+        with patch('pgdedupe.pipeline.cluster') as cluster:
+            run_pipeline(con, config, dbconfig, resume=True)
+        assert not cluster.called
+        assert completed_stages(con, config) == list(STAGES)
+        con.close()
+    finally:
+        psql.stop()
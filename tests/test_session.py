@@ -0,0 +1,54 @@
+from pgdedupe.session import stage_settings, setting_value, tuned
+
+
+def test_stage_settings_override_profile():
+    config = {'session_profile': 'high_throughput',
+              'session_settings': {'create_blocking': {'work_mem': '2GB'}}}
+    settings = stage_settings(config, 'create_blocking')
+    assert settings['work_mem'] == '2GB'
+    assert settings['synchronous_commit'] == 'off'
+    assert stage_settings(dict(config, session_profile=None), 'cluster') == {}
+
+
+def test_yaml_booleans_are_formatted_for_postgres():
+    assert setting_value(False) == 'off'
+    assert setting_value(4) == '4'
+
+
+class FakeConnection(object):
+    """Records the statements run through it; every setting exists on this server"""
+    closed = False
+
+    def __init__(self):
+        self.statements = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement, params=None):
+        self.statements.append(statement)
+        self.params = params
+
+    def fetchall(self):
+        return [{'name': name} for name in self.params[0]]
+
+    def get_transaction_status(self):
+        return 0
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_settings_are_reset_when_a_stage_fails():
+    con = FakeConnection()
+    config = {'session_profile': None,
+              'session_settings': {'cluster': {'work_mem': '1GB'}}}
+    try:
+        with tuned(con, config, 'cluster'):
+            raise ValueError('stage failed')
+    except ValueError:
+        pass
+    assert con.statements[-1] == 'RESET work_mem'
@@ -0,0 +1,24 @@
+import pytest
+
+from pgdedupe.utils import prefetch
+
+
+def test_prefetch_preserves_order():
+    assert list(prefetch(iter(range(100)), 3)) == list(range(100))
+
+
+def test_prefetch_reraises():
+    def failing():
+        yield 1
+        raise ValueError('boom')
+
+    items = prefetch(failing(), 2)
+    assert next(items) == 1
+    with pytest.raises(ValueError):
+        next(items)
+
+
+def test_prefetch_stops_early():
+    items = prefetch(iter(range(1000)), 2)
+    assert next(items) == 0
+    items.close()